@@ -0,0 +1,598 @@
+#Quick and dirty benchmarks for the network side of qRadar. Run with: python benchmark.py [name]
+#With no name, they all run.
+import os
+import socket
+import subprocess
+import json
+import urllib.request
+import sys
+import tempfile
+import time
+import struct
+import random
+import math
+import gc
+import threading
+import tracemalloc
+import numpy as np
+import ysconnect as ys
+import ysstate
+import ysspatial
+import ysstca
+import ysreplay
+import yssim
+
+
+def legacyParseFlightData(message):
+    #The old parseFlightData, kept here so there's something to compare against
+    try:
+        timer = struct.unpack("I",message[0:4])[0]
+        id = struct.unpack("I",message[4:8])[0]
+        info1 = struct.unpack("h",message[8:10])[0]
+        if info1 == 3:
+            message = message[:8] + message[10:]
+        x = struct.unpack("f",message[10:14])[0]
+        y = struct.unpack("f",message[14:18])[0]
+        z = -struct.unpack("f",message[18:22])[0]
+        yaw = struct.unpack("h",message[22:24])[0]
+        pitch = struct.unpack("h",message[24:26])[0]
+        roll = struct.unpack("h",message[26:28])[0]
+        xspeed = struct.unpack("h",message[28:30])[0]
+        ySpeed = struct.unpack("h",message[30:32])[0]
+        zSpeed = struct.unpack("h",message[32:34])[0]
+        fuel = struct.unpack("h",message[50:52])[0]
+        return {"timer":timer,"id":id,"info1":info1,"x":x,"z":z,"y":y,"yaw":-yaw,"pitch":pitch,"roll":roll,"xspeed":xspeed,"ySpeed":ySpeed,"zSpeed":zSpeed,"fuel":fuel}
+    except:
+        return {"timer":0,"id":0,"info1":0,"x":0,"z":0,"y":0,"yaw":0,"pitch":0,"roll":0,"xspeed":0,"ySpeed":0,"zSpeed":0,"fuel":0}
+
+
+def legacyParseGroundObject(message):
+    #The old parseGroundObject, slicing out every field
+    if len(message) < 36:
+        return None
+    type = struct.unpack("i",message[0:4])[0]
+    id = struct.unpack("i",message[4:8])[0]
+    iff = struct.unpack("i",message[8:12])[0]
+    x = struct.unpack("f",message[12:16])[0]
+    y = struct.unpack("f",message[16:20])[0]
+    z = struct.unpack("f",message[20:24])[0]
+    yaw = struct.unpack("f",message[24:28])[0]
+    pitch = struct.unpack("f",message[28:32])[0]
+    roll = struct.unpack("f",message[32:36])[0]
+    try:
+        name = struct.unpack("64s",message[36:100])[0]
+        name = name.replace(b'\x00', b'')
+        name= name.decode()
+    except:
+        name = 'unknown'
+    length = len(message)
+    try:
+        name2 = struct.unpack("56s",message[length-57:-1])[0]
+        name2 = name2.replace(b'\x00', b'')
+        name2 = name2.decode()
+    except:
+        name2 = 'unknown'
+    return {"type":type,"id":id,"iff":iff,"x":x,"y":y,"z":z,"yaw":yaw,"pitch":pitch,"roll":roll,"name":name,"name2":name2}
+
+
+def recordedTraffic(count=20000, aircraft=100, capture=None):
+    #AIRPLANESTATE payloads, either from a capture file made with YSConnect.startRecording,
+    #or pretend traffic: a mix of both layouts from a handful of aircraft
+    if capture:
+        return [bytes(payload) for timestamp, direction, typ, payload in ys.readCapture(capture)
+                if direction == ys.CAPTURE_IN and typ == ys.messageTypes.index("FSNETCMD_AIRPLANESTATE")]
+    random.seed(1)
+    packets = []
+    for i in range(count):
+        packets.append(yssim.makeAirplaneState(i % aircraft + 1, random.uniform(-50000,50000), random.uniform(0,10000),
+                                               random.uniform(-50000,50000), random.randint(-32768,32767),
+                                               random.randint(-2000,2000), random.randint(-200,200), random.randint(-2000,2000),
+                                               timer=i, padded=(i % 3 == 0)))
+    return packets
+
+
+def timeIt(function, packets, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for packet in packets:
+            function(packet)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(packets)/best
+
+
+def benchAirplaneState(capture=None):
+    packets = recordedTraffic(capture=capture)
+    for packet in packets[:100]:
+        assert legacyParseFlightData(packet) == ys.parseFlightData(packet)
+    before = timeIt(legacyParseFlightData, packets)
+    after = timeIt(ys.decodeAirplaneState, packets)
+    print("AIRPLANESTATE decode")
+    print("  before (slice + struct.unpack): %d packets/sec" % before)
+    print("  after (Struct.unpack_from):     %d packets/sec" % after)
+    print("  speedup: %.1fx" % (after/before))
+
+
+def benchMapJoin(objects=5000, navs=250):
+    #The burst of ADDOBJECTs that comes in when we join: mostly buildings and the like, with a few nav points mixed in
+    random.seed(1)
+    kinds = ["HANGAR", "TOWER", "TERMINAL", "GROUND_VEHICLE", "LIGHT_POLE", "FUEL_TRUCK"]
+    packets = []
+    for id in range(1, objects+1):
+        if id % (objects // navs) == 0:
+            packets.append(yssim.makeGroundObject(id, random.choice(["ILS", "VORDME", "NDB"]), "@NAV%04d" % id,
+                                                  random.uniform(-50000,50000), 0, random.uniform(-50000,50000), random.uniform(-3.1,3.1)))
+        else:
+            packets.append(yssim.makeGroundObject(id, random.choice(kinds), "", random.uniform(-50000,50000), 0,
+                                                  random.uniform(-50000,50000)))
+
+    def legacy():
+        navPoints = {}
+        for packet in packets:
+            radarPoint = ys.createRadarPoints(legacyParseGroundObject(packet), ys.navTypes)
+            if radarPoint != None:
+                navPoints[radarPoint["id"]] = ys.NavPoint(radarPoint)
+        return navPoints
+
+    client = ys.YSConnect(lambda message: None)
+    def current():
+        client.navPoints = {}
+        for packet in packets:
+            client.onAddObject(None, (len(packet)+4, 5, packet))
+        return client.navPoints
+
+    before, after = legacy(), current()
+    assert sorted(before) == sorted(after)
+    for id in before:
+        assert vars(before[id]) == vars(after[id])
+    print("Map join (%d ADDOBJECTs, %d nav points)" % (objects, len(after)))
+    for name, function in (("before (slice + decode every name)", legacy), ("after (unpack_from, names on demand)", current)):
+        best = None
+        for _ in range(5):
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print("  %-37s %.2f ms" % (name + ":", best*1000))
+    start = time.perf_counter()
+    client.groundObjects.flush()
+    flushed = time.perf_counter() - start
+    print("  every object kept: %d in %d KiB, %d distinct names, written to the array in %.2f ms" %
+          (len(client.groundObjects), client.groundObjects.data.nbytes//1024, len(client.groundObjects.names), flushed*1000))
+
+
+def benchCapture():
+    #How much recording adds to each packet, compared with decoding it
+    packets = recordedTraffic()
+    path = os.path.join(tempfile.mkdtemp(), "bench.cap")
+    recorder = ys.CaptureRecorder(path)
+    typ = ys.messageTypes.index("FSNETCMD_AIRPLANESTATE")
+    decode = timeIt(ys.decodeAirplaneState, packets)
+    record = timeIt(lambda packet: recorder.record(ys.CAPTURE_IN, typ, packet), packets)
+    recorder.close()
+    count = len(ys.indexCapture(path))
+    os.remove(path)
+    print("Capture recording")
+    print("  decode AIRPLANESTATE: %.2f us/packet" % (1e6/decode))
+    print("  record to capture:    %.2f us/packet (%d packets written)" % (1e6/record, count))
+
+
+class LegacyUserList(ys.UserList):
+    #The old list backed UserList, to compare against
+    def __init__(self):
+        self.usersList = []
+        self.timeout = 15
+
+    @property
+    def users(self):
+        return self.usersList
+
+    def addUser(self, user):
+        self.usersList.append(user)
+
+    def removeUser(self, user):
+        self.usersList.remove(user)
+
+    def getUserByID(self, id):
+        for user in self.usersList:
+            if user.id == id:
+                return user
+        return None
+
+    def getUserByName(self, name):
+        for user in self.usersList:
+            if user.name == name:
+                return user
+        return None
+
+    def updateUser(self, user):
+        for i in range(len(self.usersList)):
+            if self.usersList[i].name == user.name:
+                self.usersList[i].setFlying(user.type)
+                self.usersList[i].iff = user.iff
+                self.usersList[i].id = user.id
+                self.usersList[i].seen()
+                return True
+        return False
+
+
+def benchUserList(count=1000):
+    count = int(count)
+    random.seed(1)
+    users = [{"name": "user%04d" % i, "id": i+1, "type": 1, "iff": i % 4} for i in range(count)]
+    ids = [random.randint(1, count*2) for _ in range(20000)] # Half of these won't be found, like AI aircraft
+    names = [random.choice(users)["name"] for _ in range(20000)]
+    updates = [ys.User(dict(random.choice(users), id=random.randint(1, count))) for _ in range(5000)]
+    print("UserList with %d users (operations/sec)" % count)
+    for label, userList in (("list", LegacyUserList()), ("dict", ys.UserList())):
+        for user in users:
+            userList.addUser(ys.User(user))
+        byID = timeIt(userList.getUserByID, ids, 3)
+        byName = timeIt(userList.getUserByName, names, 3)
+        update = timeIt(userList.updateUser, updates, 3)
+        print("  %s: getUserByID %9d, getUserByName %9d, updateUser %9d" % (label, byID, byName, update))
+
+
+class LegacyYSConnect(ys.YSConnect):
+    #Makes a brand new FlightData for every AIRPLANESTATE, the way it used to
+    def onAirplaneState(self, s, message):
+        data = ys.decodeAirplaneState(message[2])
+        if data is None or data.id == 0:
+            return
+        user = self.userList.getUserByID(data.id)
+        if user:
+            username = user.name
+        else:
+            username = "AI"
+            user = ys.User()
+        velocity = math.sqrt((data.xspeed/10)**2 + (data.ySpeed/10)**2 + (data.zSpeed/10)**2)*1.94384
+        horizontal_velocity = math.sqrt((data.xspeed/10)**2 + (data.zSpeed/10)**2)*1.94384
+        if data.zSpeed == 0 or data.xspeed == 0:
+            heading = 0
+        else:
+            heading = math.atan2(data.xspeed/10,data.zSpeed/10)*180/math.pi
+        self.planeList[data.id] = ys.FlightData.fromState(data, user, username, heading, velocity, horizontal_velocity)
+
+    def onRemoveAirplane(self, s, message):
+        self.planeList.pop(ys.headerStruct.unpack_from(message[2])[0], None)
+
+
+def benchFlightData(aircraft=500, rate=10, seconds=10):
+    #aircraft flying for seconds at rate Hz, with 1% of them leaving and a new one joining each second
+    aircraft, rate, seconds = int(aircraft), int(rate), int(seconds)
+    random.seed(1)
+    airplaneState = ys.messageTypes.index("FSNETCMD_AIRPLANESTATE")
+    removeAirplane = ys.messageTypes.index("FSNETCMD_REMOVEAIRPLANE")
+    ids = list(range(1, aircraft+1))
+    nextID = aircraft+1
+    messages = []
+    for tick in range(seconds*rate):
+        if tick % rate == 0:
+            for _ in range(max(1, aircraft//100)):
+                gone = ids.pop(random.randrange(len(ids)))
+                messages.append((8, removeAirplane, struct.pack("II", gone, 0)))
+                ids.append(nextID)
+                nextID += 1
+        for id in ids:
+            messages.append((64, airplaneState, yssim.makeAirplaneState(id, id*10.0, 1000.0, tick*5.0, 0, 1000, 0, 1000, timer=tick)))
+    sock = ysreplay.NullSocket()
+    print("FlightData, %d aircraft at %dHz for %ds (%d packets)" % (aircraft, rate, seconds, len(messages)))
+    fromState = ys.FlightData.__dict__["fromState"]
+    for label, client in (("new record per packet", LegacyYSConnect(lambda message: None)), ("updated in place", ys.YSConnect(lambda message: None))):
+        created = [0]
+        def counting(cls, *args):
+            created[0] += 1
+            return fromState.__func__(cls, *args)
+        ys.FlightData.fromState = classmethod(counting) # Every FlightData either client makes comes through here
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            for message in messages:
+                client.handleMessage(sock, message)
+        finally:
+            ys.FlightData.fromState = fromState
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        #Just the records still in use and the values in them, not the User they point to. The total is everything
+        #the client holds, which for the in place one includes the state store, track history and change feed as well.
+        records = sum(sys.getsizeof(flight) + sum(sys.getsizeof(getattr(flight, name)) for name in ys.FlightData.__slots__
+                                                  if isinstance(getattr(flight, name, None), (int, float, str)))
+                      for flight in client.planeList.values())
+        print("  %s: %d records allocated, %d KiB in FlightData, %d KiB held in total, %d KiB peak, %d packets/sec" % (
+            label, created[0], records//1024, current//1024, peak//1024, len(messages)/elapsed))
+    flight = next(iter(client.planeList.values()))
+    print("  FlightData is %d bytes with __slots__ (no __dict__)" % sys.getsizeof(flight))
+
+
+def benchDerived(aircraft=1000):
+    #Knots, FL, heading and trend for every aircraft: one at a time (like updatePlanes did) vs one vectorised pass
+    aircraft = int(aircraft)
+    random.seed(1)
+    client = ys.YSConnect(lambda message: None)
+    sock = ysreplay.NullSocket()
+    for id in range(1, aircraft+1):
+        client.handleMessage(sock, (64, 11, yssim.makeAirplaneState(id, random.uniform(-5e4,5e4), random.uniform(0,1e4), random.uniform(-5e4,5e4),
+                                                                    random.randint(-32768,32767), random.randint(-2000,2000),
+                                                                    random.randint(-200,200), random.randint(-2000,2000))))
+    def scalar():
+        for flight in client.planeList.values():
+            knots = math.sqrt((flight.xspeed/10)**2 + (flight.zSpeed/10)**2)*1.94384
+            fl = int(flight.y*3.28084/100)
+            heading = flight.getHeading()
+            trend = 1 if flight.ySpeed/10 > 2.5 else (-1 if flight.ySpeed/10 < -2.5 else 0)
+    def vectorised():
+        client.aircraftState.derived()
+    scalarTime = timeIt(lambda _: scalar(), range(20))
+    vectorTime = timeIt(lambda _: vectorised(), range(20))
+    print("Derived fields for %d aircraft" % aircraft)
+    print("  one at a time: %.3f ms/tick" % (1000/scalarTime))
+    print("  vectorised:    %.3f ms/tick" % (1000/vectorTime))
+
+
+def benchHistory(aircraft=1000, length=120):
+    #Track history for lots of aircraft: cost per point, cost of reading a trail, and how much memory it all takes
+    aircraft, length = int(aircraft), int(length)
+    store = ysstate.AircraftStateStore(historyLength=length, historyInterval=0)
+    states = [ys.decodeAirplaneState(yssim.makeAirplaneState(id, id*10.0, 1000.0, 0.0)) for id in range(1, aircraft+1)]
+    now = [0.0]
+    def tick(_):
+        now[0] += 1
+        for state in states:
+            store.update(state, now[0])
+        store.history.flush()
+    ticks = timeIt(tick, range(length*3), 1) # Enough to wrap round every ring a few times
+    reads = timeIt(lambda id: store.track(id, 30), range(1, aircraft+1))
+    print("Track history, %d aircraft x %d points" % (aircraft, length))
+    print("  update + append + flush: %.2f us/point" % (1e6/(ticks*aircraft)))
+    print("  last 30 points:          %.2f us/read (view: %s)" % (1e6/reads, store.track(1, 30).base is not None))
+    print("  memory:                  %.1f MiB, fixed" % (store.history.nbytes()/1048576))
+
+
+def benchExtrapolate(aircraft=1000):
+    aircraft = int(aircraft)
+    store = ysstate.AircraftStateStore()
+    for id in range(1, aircraft+1):
+        store.update(ys.decodeAirplaneState(yssim.makeAirplaneState(id, id*10.0, 1000.0, 0.0, 0, 1000, 0, 1000)))
+    frames = timeIt(lambda _: store.extrapolate(), range(200))
+    #Due south is -32768 on the wire, which used to overflow the yaw column once negated and stop every flush
+    edge = ysstate.AircraftStateStore()
+    edge.update(ys.decodeAirplaneState(yssim.makeAirplaneState(1, 0.0, 1000.0, 0.0, 32768, 0, 0, -1000)))
+    assert edge.derived()["heading"].tolist() == [180.0] and len(edge.extrapolate()["ids"]) == 1
+    print("Dead reckoning, %d aircraft: %.3f ms/frame (%d frames/sec possible)" % (aircraft, 1000/frames, frames))
+
+
+def benchSpatial(aircraft=2000, queries=2000):
+    #Range, nearest and box queries on the grid, against going through every aircraft
+    aircraft = int(aircraft)
+    random.seed(1)
+    positions = [(id, random.uniform(-200000,200000), random.uniform(0,12000), random.uniform(-200000,200000)) for id in range(1, aircraft+1)]
+    index = ysspatial.SpatialIndex()
+    start = time.perf_counter()
+    index.updateMany(positions)
+    built = time.perf_counter() - start
+    positions = [(id, x + random.uniform(-200,200), y, z + random.uniform(-200,200)) for id, x, y, z in positions] # A second's flying
+    start = time.perf_counter()
+    index.updateMany(positions)
+    moved = time.perf_counter() - start
+    points = [(random.uniform(-200000,200000), random.uniform(-200000,200000)) for _ in range(queries)]
+    radius = 10*ysspatial.NM_TO_M
+
+    def scanRange(x, z):
+        return sorted((math.sqrt((px-x)**2 + (pz-z)**2), id) for id, px, py, pz in positions if (px-x)**2 + (pz-z)**2 <= radius*radius)
+
+    def scanNearest(x, z):
+        return min((math.sqrt((px-x)**2 + (pz-z)**2), id) for id, px, py, pz in positions)
+
+    def perQuery(function):
+        start = time.perf_counter()
+        for x, z in points:
+            function(x, z)
+        return (time.perf_counter() - start)/len(points)*1e6
+
+    for x, z in points[:50]:
+        assert index.withinRange(x, z, radius) == scanRange(x, z)
+        assert index.nearest(x, z)[0] == scanNearest(x, z)
+    print("Spatial index, %d aircraft in %d cells" % (aircraft, len(index.cells)))
+    print("  build: %.2f ms, everyone moving: %.2f ms" % (built*1000, moved*1000))
+    print("  within 10 nm: %7.1f us/query (scanning everyone %.1f us)" % (perQuery(lambda x, z: index.withinRange(x, z, radius)), perQuery(scanRange)))
+    print("  nearest:      %7.1f us/query (scanning everyone %.1f us)" % (perQuery(lambda x, z: index.nearest(x, z)), perQuery(scanNearest)))
+    print("  nearest 10:   %7.1f us/query" % perQuery(lambda x, z: index.nearest(x, z, 10)))
+    print("  20x20 nm box: %7.1f us/query" % perQuery(lambda x, z: index.inBox(x - radius, z - radius, x + radius, z + radius)))
+
+
+def benchConflicts(aircraft=1000, area=400):
+    #Short term conflict alert over aircraft scattered over area x area km, against checking every pair
+    aircraft = int(aircraft)
+    area = float(area)*1000
+    random.seed(1)
+    store = ysstate.AircraftStateStore()
+    for id in range(1, aircraft+1):
+        heading = random.uniform(0, 2*math.pi)
+        speed = random.uniform(600, 2800) # 0.1 m/s, so 120-540 knots
+        store.update(ys.decodeAirplaneState(yssim.makeAirplaneState(id, random.uniform(-area/2, area/2), random.uniform(300, 12000),
+                                                                    random.uniform(-area/2, area/2), 0, int(speed*math.sin(heading)),
+                                                                    random.randint(-150, 150), int(speed*math.cos(heading)))))
+    detector = ysstca.ConflictDetector()
+    now = time.time() # Same instant for both, or they'd be dead reckoning to different places
+    checks = timeIt(lambda _: detector.checkStore(store, now), range(20))
+    conflicts = detector.conflicts
+    state = store.extrapolate(now, detector.maxAge)
+    rows = store.data[state["slots"]]
+    position = np.column_stack((state["x"], state["y"], state["z"])).astype(np.float64)
+    velocity = np.column_stack((rows["xspeed"]/10, rows["ySpeed"]/10, -rows["zSpeed"]/10))
+    first, second = np.triu_indices(len(position), 1)
+    start = time.perf_counter()
+    everyPair = detector.closestApproach(state["ids"], position, velocity, first, second)
+    everyPairTime = time.perf_counter() - start
+    assert everyPair == conflicts
+    print("STCA, %d aircraft over %gx%g km: %d conflicts" % (aircraft, area/1000, area/1000, len(conflicts)))
+    print("  grid + CPA: %.2f ms/check, %d of %d pairs solved" % (1000/checks, detector.candidates, len(first)))
+    print("  every pair: %.2f ms/check" % (everyPairTime*1000))
+
+
+def makeCapture(path, aircraft=200, seconds=10, rate=10):
+    #Writes a capture of aircraft flying in straight lines, each reporting rate times a second
+    recorder = ys.CaptureRecorder(path)
+    typ = ys.messageTypes.index("FSNETCMD_AIRPLANESTATE")
+    start = time.monotonic_ns()
+    for tick in range(seconds*rate):
+        timestamp = start + int(tick*1e9/rate)
+        for id in range(1, aircraft+1):
+            payload = yssim.makeAirplaneState(id, id*100 + tick*20.0, 3000, id*50 + tick*10.0, 0, 2000, 0, 1000, timer=tick)
+            recorder.buffer += ys.captureHeaderStruct.pack(timestamp, ys.CAPTURE_IN, typ, len(payload))
+            recorder.buffer += payload
+    recorder.close()
+
+
+def benchReplay(capture=None):
+    #The whole ingest path (decode, dispatch, UserList, planeList) fed from a capture as fast as it'll go
+    if capture is None:
+        capture = os.path.join(tempfile.mkdtemp(), "replay.cap")
+        makeCapture(capture)
+    replay = ysreplay.CaptureReplay(capture, speed=0)
+    print("Capture replay (%d packets)" % len(replay))
+    stats = replay.feed(ys.YSConnect(lambda message: None))
+    print("  direct feed: %d packets/sec" % stats["packetsPerSecond"])
+    stats = replay.runSocketpair(ys.YSConnect(lambda message: None))
+    print("  socketpair:  %d packets/sec" % stats["packetsPerSecond"])
+
+
+def threadCPU(thread):
+    #CPU seconds used by another thread so far. Linux only, elsewhere falls back to the whole process.
+    try:
+        with open("/proc/self/task/%d/stat" % thread.native_id) as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, AttributeError, ValueError):
+        return time.process_time()
+
+
+def benchCPU(duration=5.0):
+    #How much CPU the connection thread burns sitting idle on a quiet server, and keeping up with a busy one
+    duration = float(duration)
+    print("Connection thread CPU")
+    for aircraft, rate in ((0, 10.0), (500, 10.0)):
+        server = yssim.SimServer(aircraft=aircraft, rate=rate, navs=20, chatInterval=0)
+        port = server.start()
+        client = ys.YSConnect(lambda message: None)
+        thread = threading.Thread(target=client.connect, args=("127.0.0.1", port), daemon=True)
+        thread.start()
+        while not client.connected:
+            time.sleep(0.01)
+        time.sleep(0.5)
+        startCPU = threadCPU(thread)
+        startMessages = client.messagesReceived
+        start = time.perf_counter()
+        time.sleep(duration)
+        elapsed = time.perf_counter() - start
+        used = threadCPU(thread) - startCPU
+        received = client.messagesReceived - startMessages
+        client.disconnect()
+        server.stop()
+        thread.join(5)
+        print("  %4d aircraft @ %g Hz: %5.1f%% CPU, %d packets/sec" % (aircraft, rate, 100*used/elapsed, received/elapsed))
+
+
+def processCPU(pid):
+    #CPU seconds used by another process so far (Linux only)
+    with open("/proc/%d/stat" % pid) as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def benchDaemon(aircraft=1000, rate=10.0, viewers=4, duration=5.0):
+    #python -m ysdaemon keeping up with a busy server while viewers follow /events. The daemon gets a process of its
+    #own, as it would for real, so the simulated server and the viewers here aren't competing with it.
+    aircraft, rate, viewers, duration = int(aircraft), float(rate), int(viewers), float(duration)
+    server = yssim.SimServer(aircraft=aircraft, rate=rate, navs=20, chatInterval=0)
+    port = server.start()
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    listen = probe.getsockname()[1]
+    probe.close()
+    daemon = subprocess.Popen([sys.executable, "-m", "ysdaemon", "127.0.0.1", "--port", str(port), "--listen", str(listen)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+
+    def stats():
+        with urllib.request.urlopen("http://127.0.0.1:%d/stats" % listen) as response:
+            return json.load(response)
+
+    try:
+        while True:
+            try:
+                if stats()["connected"]:
+                    break
+            except OSError:
+                pass
+            time.sleep(0.1)
+        time.sleep(1.0)
+        received = [[0, 0] for _ in range(viewers)] # Events, bytes
+        stop = threading.Event()
+
+        def follow(counts):
+            events = socket.create_connection(("127.0.0.1", listen))
+            events.sendall(b"GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            reader = events.makefile("rb")
+            while not stop.is_set():
+                line = reader.readline()
+                if not line:
+                    break
+                counts[1] += len(line)
+                if line.startswith(b"event:"):
+                    counts[0] += 1
+            events.close()
+
+        for counts in received:
+            threading.Thread(target=follow, args=(counts,), daemon=True).start()
+        time.sleep(0.5)
+        before = stats()
+        startCPU = processCPU(daemon.pid)
+        startReceived = [list(counts) for counts in received]
+        start = time.perf_counter()
+        time.sleep(duration)
+        elapsed = time.perf_counter() - start
+        used = processCPU(daemon.pid) - startCPU
+        after = stats()
+        events = [counts[0] - was[0] for counts, was in zip(received, startReceived)]
+        streamed = sum(counts[1] - was[1] for counts, was in zip(received, startReceived))
+        stop.set()
+    finally:
+        daemon.terminate()
+        daemon.wait(5)
+        server.stop()
+    print("Headless daemon, %d aircraft @ %g Hz, %d viewers on /events" % (aircraft, rate, viewers))
+    print("  ingest: %d packets/sec (the server sends %d), daemon %.1f%% CPU" %
+          ((after["packets"] - before["packets"])/elapsed, aircraft*rate, 100*used/elapsed))
+    print("  snapshots published: %d, events per viewer: %s" % (after["generation"] - before["generation"], events))
+    if viewers:
+        print("  streamed: %.0f KiB/sec per viewer" % (streamed/viewers/elapsed/1024))
+
+
+benchmarks = {
+    "airplanestate": benchAirplaneState,
+    "mapjoin": benchMapJoin,
+    "capture": benchCapture,
+    "replay": benchReplay,
+    "userlist": benchUserList,
+    "flightdata": benchFlightData,
+    "derived": benchDerived,
+    "history": benchHistory,
+    "extrapolate": benchExtrapolate,
+    "spatial": benchSpatial,
+    "stca": benchConflicts,
+    "cpu": benchCPU,
+    "daemon": benchDaemon,
+}
+
+if __name__ == "__main__":
+    #python benchmark.py name [args], eg python benchmark.py airplanestate mycapture.cap
+    if len(sys.argv) > 1:
+        benchmarks[sys.argv[1]](*sys.argv[2:])
+    else:
+        for benchmark in benchmarks.values():
+            benchmark()
@@ -16,12 +16,15 @@ from PyQt5 import uic
 import sys, _thread, json, configparser, os, math, threading
 from queue import Queue
 import ysconnect as ys
+import ysstate
+import ysbridge
 from FieldParser import FieldParser as fp
 import resources
 import qdarktheme
 
 navigationPoints = {}
 aircrafts = {}
+userRows = {} # User name -> row in the user table
 userList = {}
 notFlyingList = [] # Got 2 userlists, one for flying, and one for not.... It's annoying, but id is the sorting index for planes, so I need to keep track of it
 serverMessage = ""
@@ -653,6 +656,10 @@ class MapWindow(QWidget):
         
             if type(item) == PlaneSymbol:
                 self.selectPlaneOnMap(item)
+            else: # Near misses count too, the symbols are only small
+                plane = self.nearestPlane(event.pos())
+                if plane is not None:
+                    self.selectPlaneOnMap(plane)
 
         if event.button() == Qt.RightButton:
             
@@ -698,6 +705,20 @@ class MapWindow(QWidget):
             pass
         return super(MapWindow, self).eventFilter(source, event)
     
+    def nearestPlane(self, position, pixels=15):
+        '''Nearest plane symbol to a point on the map window, if there's one within pixels of it'''
+        client = self.mainWindow.flightDirector.client
+        if client is None:
+            return None
+        scenePosition = self.view.mapToScene(self.view.viewport().mapFrom(self, position))
+        radius = pixels/max(self.view.transform().m11(), 1e-9) # Scene units are metres
+        nearest = client.spatialIndex.nearest(scenePosition.x(), scenePosition.y(), 1, radius)
+        if nearest:
+            aircraft = aircrafts.get(nearest[0][1])
+            if aircraft is not None and aircraft.symbol is not None:
+                return aircraft.symbol
+        return None
+
     def selectPlaneOnMap(self, plane):
         '''Selects a plane on the map, and updates the aircraft details tab'''
         if self.mapHighlightedObject: # Clear anything that was previously selected
@@ -963,7 +984,10 @@ class EditCallsignDialog(QDialog):
         self.layout.addWidget(cancelButton, 1, 1)
 
     def saveEdit(self):
-        self.currentPlane.callsign = self.layout.itemAtPosition(0, 1).widget().text()
+        #The override goes straight on the FlightData, so the username isn't mistaken for one later. Blank clears it.
+        flight = self.currentPlane.parent
+        flight.setCallsign(self.layout.itemAtPosition(0, 1).widget().text() or None)
+        self.currentPlane.callsign = flight.getCallsign()
         self.currentPlane.update()
         self.close()
 
@@ -982,6 +1006,7 @@ class PlaneSymbol(QGraphicsItem):
         
         self.setFlag(QGraphicsItem.ItemIgnoresTransformations,True)
         self.clicked = False
+        self.conflict = False # Short term conflict alert
         self.change = 0
         self.parent = parent
 
@@ -996,6 +1021,8 @@ class PlaneSymbol(QGraphicsItem):
 
         if self.clicked:
             painter.setPen(QPen(Qt.red))
+        elif self.conflict:
+            painter.setPen(QPen(Qt.yellow))
         else:
             painter.setPen(QPen(Qt.white))
 
@@ -1004,6 +1031,8 @@ class PlaneSymbol(QGraphicsItem):
 
         if self.clicked:
             dashedPen = QPen(Qt.red)
+        elif self.conflict:
+            dashedPen = QPen(Qt.yellow)
         else:
             dashedPen = QPen(Qt.white)
 
@@ -1206,12 +1235,30 @@ class FlightDirector():
         self.mainWindow = parent
         self.client = None
         self.connected = False
-        self.client = ys.YSConnect(self.incomingMessage)
+        #The client runs on its own thread, so everything it sends us goes through the bridge and is handed out on the GUI thread
+        #by bridgeTimer, every bridgeInterval ms. Weather and the like only need the latest one, see coalesceMessages.
+        self.coalesceMessages = ("weather", "MAP", "STCA")
+        self.bridgeInterval = 50
+        self.bridge = ysbridge.MessageBridge(self.coalesceMessages)
+        self.client = ys.YSConnect(self.bridge.post)
+        self.client.registerHandler("FSNETCMD_AIRPLANESTATE", self.markPlanes)
+        self.client.registerHandler("FSNETCMD_REMOVEAIRPLANE", self.markPlanes)
+        self.lastSnapshot = self.client.getSnapshot()
+        self.bridgeTimer = QTimer()
+        self.bridgeTimer.timeout.connect(self.drainBridge)
+        self.bridgeTimer.start(self.bridgeInterval)
         self.latestMessage = None
         self.subscribedToMessages = []
+        self.conflicting = set() # Ids of aircraft in the latest STCA alerts
+        self.subscribeToMessage(self.updateConflicts)
         self.timer = QTimer()
         self.timer.timeout.connect(self.update)
         self.timer.start(2500)
+        #In between the full updates, move the planes along where we reckon they've got to, so they glide rather than jump
+        self.extrapolationMaxAge = 5.0
+        self.motionTimer = QTimer()
+        self.motionTimer.timeout.connect(self.updateMotion)
+        self.motionTimer.start(100)
         self.mapLoaded = False
         self.messageList = []
         self.username = "radar"
@@ -1224,11 +1271,25 @@ class FlightDirector():
         self.client.disconnect()
         self.connected = False
 
+    def markPlanes(self, s, message):
+        #Network thread, so just flag it
+        self.bridge.mark("planes")
+
+    def drainBridge(self):
+        messages, marks = self.bridge.drain()
+        for message in messages:
+            self.incomingMessage(message)
+
+    def getBridgeStats(self):
+        #How long messages (messageLatency) and aircraft updates (markLatency) take to get from the network thread to us
+        return self.bridge.getStats()
+
     def incomingMessage(self, message):
+        #Only ever called on the GUI thread
         self.latestMessage = message
         if type(message) == str:
             self.messageList.append(message)            
-        for listener in self.subscribedToMessages:
+        for listener in list(self.subscribedToMessages): # Listeners can unsubscribe themselves
             listener(message)
         
         if "Logged in!" in message:
@@ -1237,6 +1298,20 @@ class FlightDirector():
     def subscribeToMessage(self, listener):
         self.subscribedToMessages.append(listener)
 
+    def updateConflicts(self, message):
+        #["STCA", conflicts] from the client, flags the symbols so they're drawn in the alert colour
+        if type(message) == list and message[0] == "STCA":
+            conflicting = set()
+            for conflict in message[1]:
+                conflicting.add(conflict.first)
+                conflicting.add(conflict.second)
+            for id in conflicting | self.conflicting:
+                aircraft = aircrafts.get(id)
+                if aircraft is not None and aircraft.symbol is not None:
+                    aircraft.symbol.conflict = id in conflicting
+                    aircraft.symbol.update()
+            self.conflicting = conflicting
+
     def unsubscribeToMessage(self, listener):
         try:
             self.subscribedToMessages.remove(listener)
@@ -1244,14 +1319,29 @@ class FlightDirector():
             pass
     
     def update(self):
-        #Update every 5 seconds
+        #Update every 2.5 seconds, from the client's latest snapshot. Anything that hasn't changed since last time is skipped.
         if self.connected:
-            updateUsers(self.mainWindow.userTable, self.client.getUsers())
-            updatePlanes(self.mainWindow, self.client.getPlanes(), self.client.getNavPoints())
+            snapshot = self.client.getSnapshot()
+            last = self.lastSnapshot
+            #Every time, whether the users have changed or not. There aren't many, and the flying times keep going up.
+            updateUsers(self.mainWindow.userTable, snapshot.users)
+            if snapshot.planesGeneration != last.planesGeneration or snapshot.navsGeneration != last.navsGeneration:
+                #Worked out from the snapshot's copy of the state array, the live store belongs to the connection thread
+                derived = ysstate.deriveRows(snapshot.state, climbThreshold=self.client.aircraftState.climbThreshold)
+                changes = self.client.getChanges(last.generation, snapshot)
+                if changes is None: # Been too long, or we've not started yet, so go through everything
+                    updatePlanes(self.mainWindow, snapshot.planes, snapshot.navPoints, derived)
+                else:
+                    applyChanges(self.mainWindow, snapshot, changes, derived)
+            self.lastSnapshot = snapshot
         if self.mapLoaded:
             updateBasemap(self.mainWindow)
             self.mapLoaded = False
 
+    def updateMotion(self):
+        if self.connected:
+            updatePlanePositions(ysstate.extrapolateRows(self.client.getSnapshot().state, maxAge=self.extrapolationMaxAge))
+
     def sendMessage(self, message):
         self.client.sendMessage(message)
     
@@ -1277,6 +1367,9 @@ def msToKnots(ms):
 def mToFL(m):
     ft = m*3.28084
     fl = int(ft/100)
+    return flToString(fl)
+
+def flToString(fl):
     if fl < 100:
         return "0"+str(fl)
     else:
@@ -1320,148 +1413,189 @@ def drawGrid(scene,number,gap,origin):
         line.setPen(pen)
         scene.addItem(line)
 
-def updateUsers(userTable, newUserList):
-    
-    for user in newUserList.getUsers():
-        if user.deleteFlag: #Remove the user if they've been flagged as to delete. 
-            if user.tableRow != None:
-                userTable.removeRow(user.tableRow)
-                user.tableRow = None
-            newUserList.removeUser(user)
-        else:
-            if user.tableRow != None:
-                userTable.item(user.tableRow, 0).setText(user.name)
-                if user.flying:
-                    userTable.item(user.tableRow, 1).setIcon(QIcon(":icons/airplane.png"))
-                else:
-                    userTable.item(user.tableRow, 1).setIcon(QIcon(":icons/home.png"))
-                userTable.item(user.tableRow, 2).setText(str(user.getFlyingTime(True)))
+def updateUsers(userTable, users):
+    #users is a snapshot's {name: User}. The connection thread drops anyone who's timed out, so whoever isn't in it any
+    #more comes out of the table. Which row is whose is kept here in userRows, not on the User.
+    for name in [name for name in userRows if name not in users]:
+        row = userRows.pop(name)
+        userTable.removeRow(row)
+        for other, otherRow in userRows.items(): # Everything below moves up one
+            if otherRow > row:
+                userRows[other] = otherRow - 1
+    for name, user in users.items():
+        row = userRows.get(name)
+        if row is not None:
+            userTable.item(row, 0).setText(user.name)
+            if user.flying:
+                userTable.item(row, 1).setIcon(QIcon(":icons/airplane.png"))
+            else:
+                userTable.item(row, 1).setIcon(QIcon(":icons/home.png"))
+            userTable.item(row, 2).setText(str(user.getFlyingTime(True)))
 
-                userTable.item(user.tableRow, 3).setText(str(user.iff+1))
-                setTableCellColourFromIFF(userTable.item(user.tableRow, 3), user.iff)
-                
+            userTable.item(row, 3).setText(str(user.iff+1))
+            setTableCellColourFromIFF(userTable.item(row, 3), user.iff)
+            
+        else:
+            row = userRows[name] = userTable.rowCount()
+            userTable.insertRow(row)
+            userTable.setItem(row, 0, QTableWidgetItem(user.name))
+            if user.flying:
+                userTable.setItem(row, 1, QTableWidgetItem(QIcon(":icons/airplane.png"), ""))
             else:
-                user.tableRow = userTable.rowCount()
-                userTable.insertRow(user.tableRow)
-                userTable.setItem(user.tableRow, 0, QTableWidgetItem(user.name))
-                if user.flying:
-                    userTable.setItem(user.tableRow, 1, QTableWidgetItem(QIcon(":icons/airplane.png"), ""))
-                else:
-                    userTable.setItem(user.tableRow, 1, QTableWidgetItem(QIcon(":icons/home.png"), ""))
-                userTable.setItem(user.tableRow, 2, QTableWidgetItem(str(user.getFlyingTime(True))))
-                userTable.setItem(user.tableRow, 3, QTableWidgetItem(str(user.iff+1)))
-                setTableCellColourFromIFF(userTable.item(user.tableRow, 3), user.iff)
+                userTable.setItem(row, 1, QTableWidgetItem(QIcon(":icons/home.png"), ""))
+            userTable.setItem(row, 2, QTableWidgetItem(str(user.getFlyingTime(True))))
+            userTable.setItem(row, 3, QTableWidgetItem(str(user.iff+1)))
+            setTableCellColourFromIFF(userTable.item(row, 3), user.iff)
 
 def setTableCellColourFromIFF(tableCell, iff):
     colours = [QColor(0,0,255), QColor(255,0,0), QColor(0,128,0), QColor(255,0,255)]
     tableCell.setBackground(colours[iff])
 
-def updatePlanes(mainWindow, planes, navs):
+def derivedLookup(derived):
+    #derived is ysstate.deriveRows (or AircraftStateStore.derived), with the knots/FL/heading/trend for every aircraft worked out in one go.
+    #Returns a function giving those four for one aircraft.
+    if derived is None:
+        derived = ysstate.deriveRows(ysstate.AircraftStateStore().snapshot())
+    derivedRow = {id: row for row, id in enumerate(derived["ids"].tolist())}
+    derivedKnots = derived["knots"].tolist()
+    derivedFL = derived["flightLevel"].tolist()
+    derivedHeading = derived["heading"].tolist()
+    derivedTrend = derived["trend"].tolist()
+    def lookup(key, flight):
+        row = derivedRow.get(key)
+        if row is not None:
+            return derivedKnots[row], derivedFL[row], derivedHeading[row], derivedTrend[row]
+        # Not in the state store (yet), work it out the slow way
+        return flight.getSpeed(), int(flight.getAltitude()*3.28084/100), flight.getHeading(), 0
+    return lookup
+
+def addAircraft(mainWindow, key, flight, knots, fl, heading, trend):
     mapScene = mainWindow.mapScene
     tableWidget = mainWindow.tableWidget
-    tempAircrafts = {}
-    tempNavs = {}
-    for id in planes:
-        #Check if the plane is already in the list, first add the plane to a temp list
-        
-        tempAircrafts[id] = planes[id]
-
-    for key in aircrafts.copy().keys():
-        if key not in tempAircrafts.keys():
+    aircrafts[key] = flight
+    plane = PlaneSymbol()
+    plane.setPos(flight.x,flight.z)
+    plane.change = trend
+    plane.heading = heading
+    plane.speed = knots/1.94384 # The symbol wants m/s
+    plane.callsign = flight.getCallsign()
+    plane.altitude = round(flight.getAltitude(),0)
+    plane.username = flight.username
+    plane.parent = flight
+    flight.symbol = plane
+    mapScene.addItem(plane)
+    updateAircraftOnMap(mainWindow,flight,knots,heading,trend)
+    currentRowCount = tableWidget.rowCount()
+    tableWidget.insertRow(currentRowCount)
+    tableWidget.setItem(currentRowCount,0,QTableWidgetItem(plane.callsign))
+    tableWidget.setItem(currentRowCount,1,QTableWidgetItem("FL" +flToString(fl)))
+    tableWidget.setItem(currentRowCount,2,QTableWidgetItem(str(int(knots))))
+    tableWidget.setItem(currentRowCount,3,QTableWidgetItem(str(int(heading))))
+    tableWidget.setItem(currentRowCount,4,QTableWidgetItem(str(key)))
+    flight.tableRow = currentRowCount
+
+def refreshAircraft(mainWindow, key, knots, fl, heading, trend, fields=None):
+    #fields is the set of things that changed (see ysconnect.planeFields), None to redo the lot.
+    #The FlightData belongs to the connection thread, so heading and trend go on the symbol, not on it.
+    tableWidget = mainWindow.tableWidget
+    aircraft = aircrafts[key]
+
+    #Update the table. The callsign is only set if someone's edited it, until then it's the username (which starts as
+    #"AI" until the user list catches up)
+    if tableWidget.item(aircraft.tableRow,0):
+        if fields is None or "callsign" in fields or "username" in fields:
+            tableWidget.item(aircraft.tableRow,0).setText(aircraft.getCallsign())
+        if fields is None or "y" in fields:
+            tableWidget.item(aircraft.tableRow,1).setText("FL" +flToString(fl))
+        if fields is None or "horizontal_velocity" in fields:
+            tableWidget.item(aircraft.tableRow,2).setText(str(int(knots)))
+        if fields is None or "yaw" in fields: # The column is the yaw heading from derivedLookup, not FlightData.heading (the track)
+            tableWidget.item(aircraft.tableRow,3).setText(str(int(heading)))
+        if fields is None:
+            tableWidget.item(aircraft.tableRow,4).setText(str(key))
+    updateAircraftOnMap(mainWindow,aircraft,knots,heading,trend)
+
+def removeAircraft(mainWindow, key):
+    aircraft = aircrafts.pop(key)
+    mainWindow.mapScene.removeItem(aircraft.symbol)
+    row = aircraft.tableRow
+    mainWindow.tableWidget.removeRow(row)
+    for other in aircrafts.values(): # Everything below moves up one
+        if other.tableRow is not None and other.tableRow > row:
+            other.tableRow -= 1
+
+def addNav(mainWindow, key, nav):
+    mapScene = mainWindow.mapScene
+    navigationPoints[key] = nav
+    updateNav(mainWindow, nav)
+    #Set the bbox from the nav points
+    boundingRectangle = mapScene.itemsBoundingRect()
+    boundingRectangle.setWidth(boundingRectangle.width()+100)
+    boundingRectangle.setHeight(boundingRectangle.height()+100)
+    mapScene.setSceneRect(boundingRectangle)
+
+def updatePlanes(mainWindow, planes, navs, derived=None):
+    #Brings the map and table right up to date with planes and navs, going through every one of them.
+    #applyChanges does the same from a change feed, only touching what's changed.
+    lookup = derivedLookup(derived)
+    for key in list(aircrafts.keys()):
+        if key not in planes:
             #This plane has been removed from the list, so remove it from the map
-            mapScene.removeItem(aircrafts[key].symbol)
-            tableWidget.removeRow(aircrafts[key].tableRow)
-            del aircrafts[key]
-    for key in tempAircrafts.keys():
-        if key not in aircrafts.keys():
+            removeAircraft(mainWindow, key)
+    for key, flight in list(planes.items()):
+        knots, fl, heading, trend = lookup(key, flight)
+        if key not in aircrafts:
             #This plane has been added to the list, so add it to the map
-            aircrafts[key] = tempAircrafts[key]
-            aircrafts[key].altitudeChange = 0
-            plane = PlaneSymbol()
-            plane.setPos(aircrafts[key].x,aircrafts[key].z)
-            plane.change = 0
-            plane.heading = aircrafts[key].getHeading()
-            plane.speed = msToKnots(aircrafts[key].getSpeed()/3.6)
-            plane.callsign = aircrafts[key].getCallsign()
-            plane.altitude = round(aircrafts[key].getAltitude(),0)
-            plane.username = aircrafts[key].username
-            plane.parent = aircrafts[key]
-            aircrafts[key].symbol = plane
-            mapScene.addItem(plane)
-            updateAircraftOnMap(mainWindow,aircrafts[key])
-            currentRowCount = tableWidget.rowCount()
-            tableWidget.insertRow(currentRowCount)
-            tableWidget.setItem(currentRowCount,0,QTableWidgetItem(plane.callsign))
-            tableWidget.setItem(currentRowCount,1,QTableWidgetItem("FL" +str(mToFL(plane.altitude))))
-            tableWidget.setItem(currentRowCount,2,QTableWidgetItem(str(msToKnots(int(plane.speed)))))
-            tableWidget.setItem(currentRowCount,3,QTableWidgetItem(str(plane.heading)))
-            tableWidget.setItem(currentRowCount,4,QTableWidgetItem(str(key)))
-            aircrafts[key].tableRow = currentRowCount
-
-
-            
-
-            
+            addAircraft(mainWindow, key, flight, knots, fl, heading, trend)
         else:
             #This plane is already in the list, so update it's position
-            aircraft = aircrafts[key]
-            aircraft.x = tempAircrafts[key].x
-            aircraft.y = tempAircrafts[key].y
-            aircraft.z = tempAircrafts[key].z
-            
-            aircraft.heading = tempAircrafts[key].getHeading()
-            aircraft.horizontal_velocity = tempAircrafts[key].getSpeed()
-            tempAlt = aircraft.altitude
-
-            aircraft.altitude = round(tempAircrafts[key].getAltitude(),0)
-            aircraft.altitudeChange = aircraft.altitude - tempAlt
-            if aircraft.altitudeChange > 10:
-                aircraft.altitudeChange = 1
-            elif aircraft.altitudeChange < -10:
-                aircraft.altitudeChange = -1
-            else:
-                aircraft.altitudeChange = 0
+            refreshAircraft(mainWindow, key, knots, fl, heading, trend)
 
-            #Check if the callsign has changed, if so update it
-            tempCallsign = aircraft.symbol.callsign
-            if tempCallsign != aircraft.callsign:
-                aircraft.setCallsign(tempCallsign)
-
-            if aircraft.callsign == "AI":
-                aircraft.callsign = tempAircrafts[key].getCallsign()
-            
-            #Update the table:
-            if tableWidget.item(aircraft.tableRow,0):
-                tableWidget.item(aircraft.tableRow,0).setText(aircraft.callsign)
-                tableWidget.item(aircraft.tableRow,1).setText("FL" +str(mToFL(aircraft.altitude)))
-                tableWidget.item(aircraft.tableRow,2).setText(str(int(msToKnots(aircraft.horizontal_velocity/3.6))))
-                tableWidget.item(aircraft.tableRow,3).setText(str(int(aircraft.heading)))
-                tableWidget.item(aircraft.tableRow,4).setText(str(key))
-            updateAircraftOnMap(mainWindow,aircraft)
-
-        #Process Navs:
-    for id in navs:
-        #Check if the plane is already in the list, first add the plane to a temp list
-        
-        tempNavs[id] = navs[id]
-    for key in navigationPoints.keys():
-        if key not in tempNavs.keys():
+    #Process Navs:
+    for key in list(navigationPoints.keys()):
+        if key not in navs:
             #This plane has been removed from the list, so remove it from the map
-            mapScene.removeItem(navigationPoints[key]['symbol'])
+            mainWindow.mapScene.removeItem(navigationPoints[key].symbol)
             del navigationPoints[key]
-    for key in tempNavs.keys():  
-        if key not in navigationPoints.keys():
-            #This plane has been added to the list, so add it to the map
-            navigationPoints[key] = tempNavs[key]
-            updateNav(mainWindow, navigationPoints[key])
-            #Set the bbox from the nav points
-            boundingRectangle = mapScene.itemsBoundingRect()
-            boundingRectangle.setWidth(boundingRectangle.width()+100)
-            boundingRectangle.setHeight(boundingRectangle.height()+100)
-            mapScene.setSceneRect(boundingRectangle)
+    for key, nav in list(navs.items()):
+        if key not in navigationPoints:
+            addNav(mainWindow, key, nav)
     
     mainWindow.mapWindow.fitInView()
 
+def applyChanges(mainWindow, snapshot, changes, derived=None):
+    #Applies a ysstate.ChangeSet (from YSConnect.getChanges) for the planes and navs in snapshot
+    planes = snapshot.planes
+    lookup = derivedLookup(derived)
+    for key in changes.planes.removed:
+        if key in aircrafts:
+            removeAircraft(mainWindow, key)
+    for key in changes.planes.added:
+        flight = planes.get(key)
+        if flight is not None and key not in aircrafts:
+            addAircraft(mainWindow, key, flight, *lookup(key, flight))
+    for key, fields in changes.planes.updated.items():
+        flight = planes.get(key)
+        if flight is not None and key in aircrafts:
+            refreshAircraft(mainWindow, key, *lookup(key, flight), fields=fields)
+    for key in changes.navs.removed: # REMOVEGROUND, or no longer a nav under new GroundFeatures
+        if key in navigationPoints:
+            mainWindow.mapScene.removeItem(navigationPoints[key].symbol)
+            del navigationPoints[key]
+    if changes.navs.added:
+        for key in changes.navs.added:
+            nav = snapshot.navPoints.get(key)
+            if nav is not None and key not in navigationPoints:
+                addNav(mainWindow, key, nav)
+        mainWindow.mapWindow.fitInView()
+
+def updatePlanePositions(predicted):
+    #predicted is ysstate.extrapolateRows (or AircraftStateStore.extrapolate), only planes that are already on the map get moved
+    for id, x, z in zip(predicted["ids"].tolist(), predicted["x"].tolist(), predicted["z"].tolist()):
+        aircraft = aircrafts.get(id)
+        if aircraft is not None and aircraft.symbol is not None:
+            aircraft.symbol.setPos(x, z)
+
 def updateBasemap(mainWindow):
     fieldParser = mainWindow.fieldParser
     polygons, lines, points = fieldParser.getGeometry()
@@ -1528,15 +1662,20 @@ def getGeoJSON(mainWindow, geometryType):
     geoJSON = fieldParser.getGeoJSON(geometryType)
     return geoJSON
 
-def updateAircraftOnMap(mainWindow, aircraft):
+def updateAircraftOnMap(mainWindow, aircraft, knots=None, heading=None, trend=None):
+    #heading (0-360 from north) and trend are the GUI's own, from derivedLookup. Left as None the symbol keeps what it had.
     aircraftSymbol  = aircraft.symbol
     aircraftSymbol.setPos(aircraft.x,aircraft.z)
 
-    aircraftSymbol.heading = aircraft.heading
-    aircraftSymbol.speed = msToKnots(aircraft.getSpeed()/3.6)
+    if heading is not None:
+        aircraftSymbol.heading = heading
+    if knots is None:
+        knots = aircraft.getSpeed()
+    aircraftSymbol.speed = knots/1.94384 # The symbol wants m/s
     aircraftSymbol.altitude = aircraft.getAltitude()
     aircraftSymbol.callsign = aircraft.getCallsign()
-    aircraftSymbol.change = aircraft.altitudeChange
+    if trend is not None:
+        aircraftSymbol.change = trend
     aircraftSymbol.update()
     if aircraftSymbol.clicked:
         mainWindow.mapView.centerOn(aircraftSymbol)
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import deque
+import ysmetrics
+
+#Gets things from the network thread over to the GUI thread, so Qt is only ever touched from its own thread.
+#The network side calls:
+#   post(message) - a callback message. Every one gets delivered, in the order they were posted, unless its key
+#                   (message[0] of a list message, eg "weather") is in coalesce, then only the latest one is kept.
+#   mark(key)     - a flag that something's changed, eg new aircraft positions. However often it's marked between drains,
+#                   it comes out once, so it costs next to nothing to mark it for every packet.
+#The GUI side calls drain() every so often (a QTimer in qRadar) and gets it all in one batch.
+#Everything remembers when it was first posted, so the latency histograms are how long things waited to be seen.
+
+class MessageBridge:
+    def __init__(self, coalesce=(), maxBatch=500):
+        self.lock = threading.Lock()
+        self.queue = deque() # (time posted, message, coalesce key or None)
+        self.latest = {} # Coalesce key -> newest message for it
+        self.marks = {} # Key -> time first marked since the last drain
+        self.coalesce = set(coalesce)
+        self.maxBatch = maxBatch # Left over messages wait for the next drain, so one drain can't hold up the GUI for long
+        self.messageLatency = ysmetrics.Histogram()
+        self.markLatency = ysmetrics.Histogram()
+        self.posted = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.largestBatch = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def post(self, message):
+        now = time.perf_counter()
+        key = None
+        if type(message) == list and message and message[0] in self.coalesce:
+            key = message[0]
+        with self.lock:
+            self.posted += 1
+            if key is not None:
+                if key in self.latest:
+                    self.latest[key] = message # Keeps its place (and time) in the queue, just with the newer message
+                    self.coalesced += 1
+                    return
+                self.latest[key] = message
+            self.queue.append((now, message, key))
+
+    def mark(self, key):
+        if key in self.marks: # Already waiting, don't bother with the lock
+            return
+        with self.lock:
+            self.marks.setdefault(key, time.perf_counter())
+
+    def drain(self):
+        #Returns (messages, marks). marks is {key: time first marked} for everything marked since the last drain.
+        with self.lock:
+            queue = self.queue
+            count = min(len(queue), self.maxBatch)
+            batch = [queue.popleft() for _ in range(count)]
+            messages = []
+            for posted, message, key in batch:
+                if key is not None:
+                    message = self.latest.pop(key)
+                messages.append(message)
+            marks = self.marks
+            self.marks = {}
+        now = time.perf_counter()
+        for posted, message, key in batch:
+            self.messageLatency.observe(now - posted)
+        for marked in marks.values():
+            self.markLatency.observe(now - marked)
+        if messages or marks:
+            self.batches += 1
+            self.delivered += len(messages)
+            self.largestBatch = max(self.largestBatch, len(messages))
+        return messages, marks
+
+    def getStats(self):
+        return {"posted": self.posted,
+                "delivered": self.delivered,
+                "coalesced": self.coalesced,
+                "pending": len(self.queue),
+                "batches": self.batches,
+                "largestBatch": self.largestBatch,
+                "messageLatency": self.messageLatency.snapshot(),
+                "markLatency": self.markLatency.snapshot()}
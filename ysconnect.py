@@ -2,9 +2,23 @@ import socket
 import time
 import struct
 import select
+import asyncio
+import threading
+import mmap
+import os
 import math
+import heapq
+import random
+import itertools
+from collections import namedtuple, Counter, deque
 from datetime import timedelta
+from types import MappingProxyType
 import FieldParser as fp
+import ysmetrics
+import ysspatial
+import ysstca
+import ysground
+import ysstate
 messageTypes = [
 	"FSNETCMD_NULL",                   #   0
 	"FSNETCMD_LOGON",                  #   1 Cli ->Svr",  (Svr->Cli for log-on complete acknowledgement.)
@@ -103,20 +117,351 @@ readbacks = ["FSNETREADBACK_ADDAIRPLANE",
 	"FSNETREADBACK_USEUNGUIDEDWEAPON",
 	"FSNETREADBACK_CTRLSHOWUSERNAME"]
 
-navTypes = {'ILS':'ILS', 'VORDME':'VORDME', 'NDB':'NDB'}
+#Ground object name -> nav type, see ysground.NavMatcher for the patterns. The prefixes catch most modded navs.
+navTypes = {'ILS':'ILS', 'VORDME':'VORDME', 'NDB':'NDB', 'ILS*':'ILS', 'VOR*':'VORDME', 'NDB*':'NDB'}
 
-def returnYSMessage(connection):
+headerStruct = struct.Struct("II") # Every YS packet starts with the size (not counting itself) and the type
+
+def recvExact(connection, count):
+    #recv can hand back less than we asked for when TCP splits the packet up, so keep going until we have it all
+    data = bytearray()
+    while len(data) < count:
+        chunk = connection.recv(count - len(data))
+        if not chunk:
+            raise ConnectionError("Socket closed")
+        data += chunk
+    return bytes(data)
+
+def returnYSMessage(connection, recorder=None):
     try:
-        size = struct.unpack("I", connection.recv(4))[0]
-        typ = struct.unpack("I", connection.recv(4))[0]
+        size, typ = headerStruct.unpack(recvExact(connection, 8))
     except:
         return (0,0,'')
     
     if size >4:
-        data = connection.recv(size-4)
-        return (size, typ, data)
+        try:
+            data = recvExact(connection, size-4)
+        except:
+            return (0,0,'')
+        message = (size, typ, data)
     else:
-        return (size, typ,'')
+        message = (size, typ,'')
+    if recorder is not None:
+        recorder.record(CAPTURE_IN, typ, message[2])
+    return message
+
+class FrameDecoder:
+    #Buffers whatever the socket gives us, and hands back complete YS packets as (size, type, data), the same as returnYSMessage.
+    #Anything left over (half a packet) stays in the buffer until the next read fills in the rest.
+    def __init__(self, bufferSize=65536):
+        self.buffer = bytearray(bufferSize)
+        self.start = 0 # First byte we haven't handed out yet
+        self.end = 0 # One past the last byte received
+
+    def __len__(self):
+        return self.end - self.start
+
+    def makeRoom(self, needed):
+        #Shuffle the unread bytes to the front, and grow the buffer if that still isn't enough
+        if self.start > 0:
+            pending = self.end - self.start
+            self.buffer[0:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        free = len(self.buffer) - self.end
+        if free < needed:
+            self.buffer.extend(bytes(max(needed - free, len(self.buffer))))
+
+    def fill(self, connection):
+        #One recv for however much is waiting on the socket. Returns the number of bytes read, 0 means the other end hung up.
+        if len(self.buffer) - self.end < 4096:
+            self.makeRoom(4096)
+        view = memoryview(self.buffer)
+        try:
+            count = connection.recv_into(view[self.end:])
+        finally:
+            view.release()
+        self.end += count
+        return count
+
+    def feed(self, data):
+        #For when the bytes come from somewhere other than a socket
+        if len(self.buffer) - self.end < len(data):
+            self.makeRoom(len(data))
+        self.buffer[self.end:self.end+len(data)] = data
+        self.end += len(data)
+
+    def nextFrame(self):
+        if self.end - self.start < 8:
+            return None
+        size, typ = headerStruct.unpack_from(self.buffer, self.start)
+        frameLength = 4 + max(size, 4)
+        if self.end - self.start < frameLength:
+            if len(self.buffer) - self.start < frameLength:
+                self.makeRoom(frameLength - (self.end - self.start)) # Big packet, make sure the rest of it will fit
+            return None
+        if size > 4:
+            data = bytes(self.buffer[self.start+8:self.start+frameLength])
+        else:
+            data = ''
+        self.start += frameLength
+        if self.start == self.end: # Everything's been read, so start from the beginning again
+            self.start = 0
+            self.end = 0
+        return (size, typ, data)
+
+    def frames(self):
+        frame = self.nextFrame()
+        while frame is not None:
+            yield frame
+            frame = self.nextFrame()
+
+#Packet capture files. They start with captureMagic, then each packet is a fixed size header followed by its payload:
+#   monotonic time (ns), direction (CAPTURE_IN or CAPTURE_OUT), 3 bytes padding, message type, payload length
+#The header never changes size, so a capture can be mmapped and indexed without parsing the payloads.
+captureMagic = b"YSQRCAP1"
+captureHeaderStruct = struct.Struct("<QB3xII")
+CAPTURE_IN = 0 # Server -> us
+CAPTURE_OUT = 1 # Us -> server
+
+class CaptureRecorder:
+    #Packets are packed into our own buffer and only written out once there's bufferSize of them, so recording costs about
+    #as much as a struct.pack per packet
+    def __init__(self, path, bufferSize=1048576):
+        self.path = path
+        self.bufferSize = bufferSize
+        self.buffer = bytearray()
+        self.file = open(path, "ab", buffering=0)
+        if self.file.tell() == 0:
+            self.buffer += captureMagic
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def record(self, direction, typ, payload):
+        if not payload:
+            payload = b''
+        with self.lock:
+            if self.file is None:
+                return
+            buffer = self.buffer
+            buffer += captureHeaderStruct.pack(time.monotonic_ns(), direction, typ, len(payload))
+            buffer += payload
+            self.count += 1
+            if len(buffer) >= self.bufferSize:
+                self.file.write(buffer)
+                buffer.clear()
+
+    def recordRaw(self, direction, data):
+        #For outgoing bytes that are already packed with their size and type on the front
+        if len(data) >= 8:
+            typ = headerStruct.unpack_from(data)[1]
+            self.record(direction, typ, data[8:])
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None and self.buffer:
+                self.file.write(self.buffer)
+                self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class RecordingSocket:
+    #Stands in for the socket while recording, so everything we send gets captured on the way out
+    def __init__(self, sock, recorder):
+        self.sock = sock
+        self.recorder = recorder
+
+    def send(self, data):
+        self.recorder.recordRaw(CAPTURE_OUT, data)
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        self.recorder.recordRaw(CAPTURE_OUT, data)
+        return self.sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class SendQueue:
+    #Everything we want to send goes in here, and the connection loop writes it out with non-blocking sends when the
+    #socket has room. Looks like a socket to the handlers. If something on another thread queues a message, wake() is
+    #called so the loop notices without having to poll.
+    def __init__(self, wake=None):
+        self.queue = deque()
+        self.offset = 0 # How much of queue[0] has already gone
+        self.wake = wake
+
+    def __len__(self):
+        return len(self.queue)
+
+    def send(self, data):
+        self.queue.append(bytes(data))
+        if self.wake is not None:
+            self.wake()
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def flush(self, sock):
+        #Sends as much as the socket will take. Returns True once the queue is empty.
+        queue = self.queue
+        while queue:
+            data = queue[0]
+            try:
+                sent = sock.send(memoryview(data)[self.offset:])
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.offset += sent
+            if self.offset < len(data):
+                return False # Socket's full, try again when it's writable
+            queue.popleft()
+            self.offset = 0
+        return True
+
+    def clear(self):
+        self.queue.clear()
+        self.offset = 0
+
+
+class ScheduledJob:
+    __slots__ = ("name", "interval", "function", "jitter", "due", "cancelled", "runs")
+
+    def __init__(self, name, interval, function, jitter=0.0):
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.jitter = jitter
+        self.due = None
+        self.cancelled = False
+        self.runs = 0
+
+    def nextDelay(self):
+        #The jitter stops every session polling its server at exactly the same moment
+        return max(0.0, self.interval + random.uniform(-self.jitter, self.jitter))
+
+
+class Scheduler:
+    #Periodic jobs kept in a heap by when they're next due. Nothing here runs on its own, whoever owns the loop
+    #sleeps for timeout() (select's timeout, or call_later on asyncio) and then calls runDue().
+    #Rescheduling or cancelling a job leaves its old heap entry behind, it's skipped when it comes up.
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = []
+        self.jobs = {}
+        self.counter = itertools.count() # Tie breaker, so the heap never has to compare two jobs
+
+    def every(self, name, interval, function, jitter=0.0, delay=None):
+        #Runs function every interval (+/- jitter) seconds, replacing any job with the same name.
+        #First run is after delay, or one interval if that's not given.
+        self.cancel(name)
+        job = ScheduledJob(name, interval, function, jitter)
+        self.jobs[name] = job
+        self.push(job, self.clock() + (job.nextDelay() if delay is None else delay))
+        return job
+
+    def push(self, job, when):
+        job.due = when
+        heapq.heappush(self.heap, (when, next(self.counter), job))
+
+    def cancel(self, name):
+        job = self.jobs.pop(name, None)
+        if job is not None:
+            job.cancelled = True
+
+    def clear(self):
+        for job in self.jobs.values():
+            job.cancelled = True
+        self.jobs.clear()
+        self.heap.clear()
+
+    def dropStale(self):
+        heap = self.heap
+        while heap and (heap[0][2].cancelled or heap[0][0] != heap[0][2].due):
+            heapq.heappop(heap)
+
+    def timeout(self, now=None):
+        #Seconds until the next job's due, or None if there aren't any
+        self.dropStale()
+        if not self.heap:
+            return None
+        if now is None:
+            now = self.clock()
+        return max(0.0, self.heap[0][0] - now)
+
+    def runDue(self, now=None):
+        if now is None:
+            now = self.clock()
+        heap = self.heap
+        ran = 0
+        while heap and heap[0][0] <= now:
+            when, count, job = heapq.heappop(heap)
+            if job.cancelled or when != job.due:
+                continue
+            self.push(job, now + job.nextDelay()) # From now, so a stall doesn't leave a backlog of runs to catch up on
+            job.runs += 1
+            ran += 1
+            try:
+                job.function()
+            except Exception as e:
+                print("Scheduled job %s failed: %s" % (job.name, e))
+        return ran
+
+
+#What the client looked like at some point, for other threads to read without locks. Nothing in one changes after it's
+#published: planes, users and navPoints are read only copies of planeList, the user list and navPoints (although the
+#FlightData, User and NavPoint objects in them are the live ones), and state is a read only copy of the aircraftState rows.
+#generation goes up every time anything changes. The per-container generations only go up when that one does, and a
+#container that hasn't changed is carried over from the last snapshot rather than copied again.
+#changes is the last changeHistory ysstate.ChangeSets, the newest last, see getChanges.
+Snapshot = namedtuple("Snapshot", ["generation","time","planes","users","navPoints","state",
+                                   "planesGeneration","usersGeneration","navsGeneration","changes"])
+planeFields = ("x","y","z","yaw","heading","horizontal_velocity","callsign","username") # What the change feed watches on a FlightData
+userFields = ("id","type","iff","flying","deleteFlag")
+
+def indexCapture(path):
+    #Returns the file offset of every packet header in a capture
+    offsets = []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(captureMagic):
+            return offsets
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(captureMagic)] != captureMagic:
+                raise ValueError(path + " isn't a qRadar capture")
+            offset = len(captureMagic)
+            end = len(data) - captureHeaderStruct.size
+            while offset <= end:
+                length = captureHeaderStruct.unpack_from(data, offset)[3]
+                if offset + captureHeaderStruct.size + length > len(data):
+                    break # Cut off part way through a packet
+                offsets.append(offset)
+                offset += captureHeaderStruct.size + length
+    return offsets
+
+def readCapture(path):
+    #Yields (time in ns, direction, type, payload) for every packet in a capture
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(captureMagic):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(captureMagic)] != captureMagic:
+                raise ValueError(path + " isn't a qRadar capture")
+            offset = len(captureMagic)
+            end = len(data) - captureHeaderStruct.size
+            while offset <= end:
+                timestamp, direction, typ, length = captureHeaderStruct.unpack_from(data, offset)
+                offset += captureHeaderStruct.size
+                if offset + length > len(data):
+                    break
+                yield (timestamp, direction, typ, data[offset:offset+length])
+                offset += length
 
 def acknowledge(connection,int_1=9, int_2=0):
     ack = struct.pack("IIiI",12,6,int_1,int_2)
@@ -148,39 +493,39 @@ def replySame(connection, message):
     msg = struct.pack("I",length)+struct.pack("I",typ)+data
     sendRaw(connection,msg)
 
-def parseFlightData(message):
+#FSNETCMD_AIRPLANESTATE comes in two layouts. When info1 is 3 there are 2 octets of padding after it, which pushes everything else along.
+#Field order: timer, id, info1, x, y, z, yaw, pitch, roll, xspeed, ySpeed, zSpeed, (16 bytes we don't use), fuel
+airplaneInfoStruct = struct.Struct("=h")
+airplaneStateStructs = {
+    False: struct.Struct("=IIhfffhhhhhh16xh"),
+    True: struct.Struct("=IIh2xfffhhhhhh16xh"), # Padded version
+}
+
+AirplaneState = namedtuple("AirplaneState", ["timer","id","info1","x","y","z","yaw","pitch","roll","xspeed","ySpeed","zSpeed","fuel"])
+
+def decodeAirplaneState(message, offset=0):
+    #Returns an AirplaneState, or None if the packet is too short to be one (empty ones come through as '', hence TypeError)
     try:
-        timer = struct.unpack("I",message[0:4])[0]
-        id = struct.unpack("I",message[4:8])[0]
-        info1 = struct.unpack("h",message[8:10])[0]
-        if info1 == 3:
-            #2 octets of padding after info1, remove these
-            message = message[:8] + message[10:]
-            
-        x = struct.unpack("f",message[10:14])[0]
-        y = struct.unpack("f",message[14:18])[0]
-        z = -struct.unpack("f",message[18:22])[0]
-        yaw = struct.unpack("h",message[22:24])[0]
-        
-        pitch = struct.unpack("h",message[24:26])[0]
-        roll = struct.unpack("h",message[26:28])[0]
-        xspeed = struct.unpack("h",message[28:30])[0]
-        ySpeed = struct.unpack("h",message[30:32])[0]
-        zSpeed = struct.unpack("h",message[32:34])[0]
-        fuel = struct.unpack("h",message[50:52])[0]
-        return {"timer":timer,"id":id,"info1":info1,"x":x,"z":z,"y":y,"yaw":-yaw,"pitch":pitch,"roll":roll,"xspeed":xspeed,"ySpeed":ySpeed,"zSpeed":zSpeed,"fuel":fuel}
-    except:
+        info1 = airplaneInfoStruct.unpack_from(message, offset+8)[0]
+        timer, id, info1, x, y, z, yaw, pitch, roll, xspeed, ySpeed, zSpeed, fuel = airplaneStateStructs[info1 == 3].unpack_from(message, offset)
+    except (struct.error, TypeError):
+        return None
+    return AirplaneState(timer, id, info1, x, y, -z, -yaw, pitch, roll, xspeed, ySpeed, zSpeed, fuel)
+
+def parseFlightData(message):
+    state = decodeAirplaneState(message)
+    if state is None:
         return {"timer":0,"id":0,"info1":0,"x":0,"z":0,"y":0,"yaw":0,"pitch":0,"roll":0,"xspeed":0,"ySpeed":0,"zSpeed":0,"fuel":0}
+    return state._asdict()
+
+userStruct = struct.Struct("=hhi") # type, iff, id. The name starts at 12 and runs to the end, less the terminator.
 
 def parseUser(message):
     try:
-        length = str(len(message)-12)+"c"
         if len(message) < 8:
             return None
-        type = struct.unpack("h",message[0:2])[0]
+        type, iff, id = userStruct.unpack_from(message)
         if type < 5:
-            iff = struct.unpack("h",message[2:4])[0]
-            id = struct.unpack("i",message[4:8])[0]
             name = message[12:-1].decode()
         else: # For some reason, sometimes you get weird messages back, with a type of 30... Which should't be possible.
             iff = 0
@@ -190,33 +535,59 @@ def parseUser(message):
     except:
         return {"name":None,"id":0,"type":0,"iff":0}
 
-def parseGroundObject(message):
-    if len(message) < 36:
-        return None
-    type = struct.unpack("i",message[0:4])[0] # Type of object, 65537 is ground objects
-    id = struct.unpack("i",message[4:8])[0] # ID of the object
-    iff = struct.unpack("i",message[8:12])[0] # IFF of the object
-    x = struct.unpack("f",message[12:16])[0] # X position of the object
-    y = struct.unpack("f",message[16:20])[0] # Y position of the object
-    z = struct.unpack("f",message[20:24])[0] # Z position of the object
-    yaw = struct.unpack("f",message[24:28])[0] # Yaw of the object
-    pitch = struct.unpack("f",message[28:32])[0] # Pitch of the object
-    roll = struct.unpack("f",message[32:36])[0] # Roll of the object
+#FSNETCMD_ADDOBJECT: type, id, iff, x, y, z, yaw, pitch, roll, then the object's name from the .dat (64 bytes at 36) and,
+#right at the end, the name it was given in the scenery editor (56 bytes, then a terminator).
+#There are thousands of these when a map loads and hardly any are nav points, so the names are only decoded when asked for.
+groundObjectStruct = struct.Struct("=iiiffffff")
+GroundObject = namedtuple("GroundObject", ["type","id","iff","x","y","z","yaw","pitch","roll"])
+nameCache = {} # Raw name -> decoded, there aren't many different object names on a map
+
+def decodeGroundObject(message, offset=0):
+    #Returns a GroundObject, or None if the packet is too short to be one (or empty, which comes through as '')
     try:
-        name = struct.unpack("64s",message[36:100])[0] # Name of the object (This is the name from the .dat)
-        name = name.replace(b'\x00', b'')   # Remove the null bytes from the string
-        name= name.decode()
-    except:
-        name = 'unknown'
-    
+        return GroundObject._make(groundObjectStruct.unpack_from(message, offset))
+    except (struct.error, TypeError):
+        return None
+
+def readName(message, start, end):
+    #Null terminated (or padded) name out of message[start:end], only copying the name itself
+    if start < 0 or len(message) < end:
+        return 'unknown'
+    stop = message.find(b'\x00', start, end)
+    raw = message[start:end if stop < 0 else stop]
+    name = nameCache.get(raw)
+    if name is None:
+        try:
+            name = raw.decode()
+        except UnicodeDecodeError:
+            name = 'unknown'
+        if len(nameCache) > 4096:
+            nameCache.clear()
+        nameCache[raw] = name
+    return name
+
+def groundObjectName(message):
+    return readName(message, 36, 100)
+
+def groundObjectName2(message):
     length = len(message)
-    try:
-        name2 = struct.unpack("56s",message[length-57:-1])[0] # Name of the object (This is the name set in scenery editor, of the nav point for example)
-        name2 = name2.replace(b'\x00', b'')
-        name2 = name2.decode()
-    except:
-        name2 = 'unknown'
-    return {"type":type,"id":id,"iff":iff,"x":x,"y":y,"z":z,"yaw":yaw,"pitch":pitch,"roll":roll,"name":name,"name2":name2}
+    return readName(message, length-57, length-1)
+
+def parseGroundObject(message):
+    groundObject = decodeGroundObject(message)
+    if groundObject is None:
+        return None
+    groundObject = groundObject._asdict()
+    groundObject["name"] = groundObjectName(message)
+    groundObject["name2"] = groundObjectName2(message)
+    return groundObject
+
+def createRadarPoint(groundObject, navType, name):
+    #Same as createRadarPoints, but from a GroundObject and a nav type that's already been looked up
+    if name.startswith("@") or name.startswith("B"): #Beacons or ILS/VOR sometimes start with them for the ai nav
+        name = name[1:]
+    return {"id": groundObject.id, "type": navType, "name": name, "x": groundObject.x, "y": groundObject.y, "z": -groundObject.z,
+            "rotation": 180 - groundObject.yaw*180/math.pi}
 
 def createRadarPoints(ground_object, updatednavTypes):
     radarPoint = {}
@@ -240,6 +611,14 @@ def createRadarPoints(ground_object, updatednavTypes):
     else:
         return None # If it's not a ground object, don't return anything
 
+#What the built in handlers turn each payload into before they can do anything with it. Only used by the metrics, which
+#time these on their own so the "parse" and "handler" timings can be told apart.
+payloadParsers = {
+    messageTypes.index("FSNETCMD_AIRPLANESTATE"): decodeAirplaneState,
+    messageTypes.index("FSNETCMD_ADDOBJECT"): decodeGroundObject,
+    messageTypes.index("FSNETCMD_LISTUSER"): parseUser,
+}
+
 def createLogin(username, conversion):
     username=username+"\x00"*(15-len(username))
     if len(username)>15:
@@ -266,194 +645,728 @@ def ysRotationToDegreesFromNorth(rotation):
 class YSConnect:
     def __init__(self, callback=None):
         
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock = self.createSocket()
         self.inputs = [self.sock]
-        self.outputs = [self.sock]
+        self.outputs = [] # Only has the socket in it while there's something waiting to be sent
+        self.outbound = SendQueue(self.wakeLoop)
+        self.writer = self.outbound # What handlers send through. Gets wrapped while recording.
+        self.loopThread = None
+        self.wakeupReader = None
+        self.wakeupWriter = None
         self.message_queues = {}
         self.navPoints = {}
         self.userList = UserList()
         self.planeList = {}
+        self.aircraftState = ysstate.AircraftStateStore() # Same aircraft as planeList, but in columns for the vectorised maths
+        self.spatialIndex = ysspatial.SpatialIndex() # Where everyone was at the last publish, for range and nearest queries
+        self.conflictDetector = ysstca.ConflictDetector()
+        self.conflicts = () # ysstca.Conflicts from the last check
         self.connected = False
         self.lastStayAlive = time.time()
+        self.scheduler = Scheduler()
+        #name: (interval, jitter) in seconds. Change them with setInterval.
+        self.timers = {"userList": (5.0, 0.5), # LISTUSER, also keeps the connection alive
+                       "airState": (30.0, 3.0), # QUERYAIRSTATE, catches anything we missed
+                       "sweep": (5.0, 0.5), # Drops aircraft we've not heard from in staleTimeout
+                       "snapshot": (0.1, 0.0), # Publishes a new Snapshot, if anything's changed
+                       "conflicts": (1.0, 0.0)} # Short term conflict alert, see checkConflicts
+        self.staleTimeout = 20.0
+        #What's changed since the last snapshot
+        self.planesDirty = False # Positions and the like
+        self.planeListDirty = False # Aircraft added or removed
+        self.usersDirty = False
+        self.navsDirty = False
+        #The change feed, what's been added/updated/removed since the last snapshot
+        self.changeHistory = 50 # How many ChangeSets each snapshot keeps, 5 seconds worth at the default snapshot timer
+        self.planeChanges = ysstate.DeltaBuilder()
+        self.touchedPlanes = set() # Had an AIRPLANESTATE, what's actually changed gets worked out when we publish
+        self.planeFields = ysstate.FieldTracker(planeFields)
+        self.userFields = ysstate.FieldTracker(userFields)
+        self.navChanges = ysstate.DeltaBuilder()
         self.callback = callback
         self.map = None
         self.navTypes = navTypes
+        self.navTypesChanged = False # updateNavTypes was called, picked up on the connection thread
+        self.navMatcher = ysground.NavMatcher(navTypes)
+        self.groundObjects = ysground.GroundObjectStore(self.navMatcher) # Everything from ADDOBJECT, navs or not
+        self.decoder = FrameDecoder()
+        self.handlers = {} # FSNETCMD number -> list of handlers
+        self.unhandledMessages = Counter()
+        self.metrics = ysmetrics.MessageMetrics(messageTypes)
+        self.metricsServer = None
+        self.host = None
+        self.port = None
+        self.messagesReceived = 0
+        self.bytesReceived = 0
+        self.recorder = None
+        #If the server drops us after we've logged in, we try again after reconnectDelay, doubling each time up to
+        #reconnectMaxDelay. reconnectAttempts of None keeps going until disconnect() is called.
+        self.autoReconnect = True
+        self.reconnectDelay = 1.0
+        self.reconnectMaxDelay = 60.0
+        self.reconnectAttempts = None
+        self.reconnects = 0
+        self.logins = 0
+        self.orphans = {} # Aircraft from before the reconnect that haven't turned up again yet
+        self.closing = False
+        self.stopWaiting = threading.Event()
+        empty = MappingProxyType({})
+        self.snapshot = Snapshot(0, time.time(), empty, empty, empty, self.aircraftState.snapshot(), 0, 0, 0, ())
+        self.snapshotListeners = [] # Called with each new Snapshot, on the connection thread, so keep them quick
+        self.registerBuiltInHandlers()
+
+    def createSocket(self):
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
     def connect(self, host, port=7915, username="radar", version=20180930):
         self.username = createLogin(username, version)
         self.host = host
         self.port = port
+        self.closing = False
+        self.stopWaiting.clear()
+        self.resetSession() # Maybe a different server, so nothing from last time carries over
+        self.resetConnection() # A socket that's been closed (disconnect) or failed to connect can't be used again
+        if not self.openConnection():
+            return False
+        attempt = 0
+        while True:
+            logins = self.logins
+            self.connection()
+            self.connected = False
+            if self.closing or not self.autoReconnect:
+                return True
+            if self.logins > logins:
+                attempt = 0 # Got back in last time, so start the backoff again
+            while True:
+                if self.reconnectAttempts is not None and attempt >= self.reconnectAttempts:
+                    self.callback("Error - Gave up reconnecting.")
+                    return True
+                delay = self.backoff(attempt)
+                attempt += 1
+                self.callback("Reconnecting in %.1f seconds" % delay)
+                if self.stopWaiting.wait(delay) or self.closing:
+                    return True
+                self.resetConnection()
+                if self.openConnection(quiet=True):
+                    self.reconnects += 1
+                    break
+
+    def openConnection(self, quiet=False):
         try: 
             self.sock.connect((self.host, self.port))
         except socket.error as msg:
             print("Connection Failed")
-            self.callback("Connection Failed, have you used the correct address?\n"+str(msg))
+            if not quiet:
+                self.callback("Connection Failed, have you used the correct address?\n"+str(msg))
             return False
         except:
             print("Connection Failed")
-            self.callback("Connection Failed, have you used the correct port?")
+            if not quiet:
+                self.callback("Connection Failed, have you used the correct port?")
             return False
-        self.connection()
         return True
 
+    def backoff(self, attempt):
+        delay = min(self.reconnectMaxDelay, self.reconnectDelay * 2**attempt)
+        return delay * random.uniform(0.5, 1.0) # So a restarted server doesn't get every client back at once
+
+    def resetSession(self):
+        #Forgets every plane, user and nav from the last connection, for a connect() (rather than reconnecting by
+        #ourselves, which keeps them, see resetConnection). Publishes a snapshot with them all removed, so anyone
+        #following the change feed clears them out too.
+        for id in self.planeList:
+            self.planeChanges.remove(id)
+        for id in self.navPoints:
+            self.navChanges.remove(id)
+        self.planeList = {}
+        self.touchedPlanes = set()
+        self.orphans = {}
+        self.aircraftState.clear()
+        self.userList = UserList()
+        self.navPoints = {}
+        self.groundObjects.clear()
+        self.conflicts = ()
+        self.map = None
+        self.planesDirty = self.planeListDirty = self.usersDirty = self.navsDirty = True
+        self.publish()
+
+    def resetConnection(self):
+        #A fresh socket and decoder for the next go. Planes, users and navs are kept, they're brought up to date once
+        #we're back in and anything that's gone is swept out by the stale timer.
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.setSocket(self.createSocket())
+        self.decoder = FrameDecoder()
+        self.outbound.clear()
+        self.connected = False
+        self.orphans = dict(self.planeList)
+
     def connection(self):
+        #The socket is non-blocking from here on. We sleep in select until there's something to read, something of
+        #ours to send (only then do we ask about writable, a connected socket is nearly always writable), or another
+        #thread has queued a message and poked the wakeup socket.
+        self.loopThread = threading.get_ident()
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+        self.wakeupWriter.setblocking(False)
+        try:
+            self.sock.setblocking(False)
+            self.writer.send(self.username)
+            self.startTimers()
+            return self.runLoop()
+        finally:
+            self.scheduler.clear()
+            self.loopThread = None
+            self.wakeupReader.close()
+            self.wakeupWriter.close()
+            self.wakeupReader = None
+            self.wakeupWriter = None
 
-        self.sock.send(self.username)
-        
+    def runLoop(self):
         while self.inputs:
             try:
-                readable, writable, exceptional = select.select(self.inputs, self.outputs, self.inputs)
-            except ValueError:
+                if self.outbound and not self.outbound.flush(self.sock):
+                    self.outputs = [self.sock]
+                else:
+                    self.outputs = []
+                readable, writable, exceptional = select.select(self.inputs + [self.wakeupReader], self.outputs, self.inputs,
+                                                                self.scheduler.timeout())
+            except (ValueError, OSError): # Socket's been closed under us
                 print("Error")
                 self.callback("Error - Likely disconnected.")
                 return False
             for s in readable:
-                if s is self.sock:
-                    s = self.sock
-                    if self.connected:
-                        currentTime = time.time()
-                        if currentTime - self.lastStayAlive > 5:
-                            self.stayAlive()
-                            self.lastStayAlive = currentTime
-                    else:
-                        pass
+                if s is self.wakeupReader:
                     try:
-                        message = returnYSMessage(s)
-                        mesgType = messageTypes[message[1]]
-                    except:
-                        mesgType = "NULL"
-                    if mesgType == "FSNETCMD_VERSIONNOTIFY":
-                        acknowledge(s,9)
-                        self.callback("Verifying version")
-
-                    elif mesgType == "FSNETCMD_USEMISSILE":
-                        acknowledge(s,readbacks.index("FSNETREADBACK_USEMISSILE"))
-                        self.callback("Verifying missile usage")
-
-                    elif mesgType == "FSNETCMD_CTRLSHOWUSERNAME":
-                        acknowledge(s,readbacks.index("FSNETREADBACK_CTRLSHOWUSERNAME"))
-                        self.callback("Verifying username display")
-
-                    elif mesgType == "FSNETCMD_USEUNGUIDEDWEAPON":
-                        acknowledge(s,readbacks.index("FSNETREADBACK_USEUNGUIDEDWEAPON"))
-                        self.callback("Verifying unguided weapon usage")
-                        
-                    elif mesgType == "FSNETCMD_LOADFIELD":
-                        replySame(s,message)
-                        length = 4
-                        typ = messageTypes.index("FSNETCMD_ENVIRONMENT")
-
-                        try:
-                            self.map = message[2].split(b'\x00')[0].decode()
-                        except:
-                            self.map = "Unknown"
-                        self.callback("Verifying map")
-                        self.callback(["MAP",self.map])
-                    
-                    elif mesgType == "FSNETCMD_CONFIGSTRING":
-                        msg_length = len(message[2])
-                        sendMessage(s,message[1],message[2],"II"+ str(msg_length) + "s")
-                        self.callback("Verifying config")
-
-                    elif mesgType == "FSNETCMD_LIST":
-                        msg_length = len(message[2])
-                        sendMessage(s,message[1],message[2],"iI"+str(msg_length) + "s")
-                        self.callback("Verifying aircraft list")
-                        
-                    elif mesgType == "FSNETCMD_PREPARESIMULATION":
-                        acknowledge(s,readbacks.index("FSNETREADBACK_PREPARE"))
-                        sendMessage(s,messageTypes.index("FSNETCMD_QUERYAIRSTATE"),0,"III")
-                        self.connected = True
-                        sendMessage(self.sock,37,0,"III") # Get users
-                        self.callback("Logged in!")
-                        
-                    elif mesgType == "FSNETCMD_ENVIRONMENT":
-                        acknowledge(s,readbacks.index("FSNETREADBACK_ENVIRONMENT"))
-                        self.callback("Verifying environment")
-                        if len(message[2])> 8:
-                            day, flags, windX, windVert, windZ, visibility = struct.unpack("IIffff",message[2])
-                            windSpeed = round(math.sqrt(windX**2 + windZ**2) * 1.94384,2) #Convert to knots
-                            windDirection = int(math.degrees(math.atan2(windX,windZ))+180)
-                            if day == 1:
-                                day = "Day"
-                            else:
-                                day = "Night"
-                            returnMessage = ["weather",{"windDirection": windDirection, "windSpeed": windSpeed, "time": day, "visibility": visibility}]
-                            self.callback(returnMessage)
-                        #Parse the packet, and create a weather message to send to the listener. message should be["weather",{"windDirection": windDirection, "windSpeed": windSpeed, "time": time, "visibility": visibility}]
-
-                    elif mesgType == "FSNETCMD_LOGON":
-                        #Sometimes this is called, sometimes not... Very weird.
-                        # Seems to be mainly not called on OpenYS, and ocasionally on 2015xxxx. Have moved the code to prepare, as
-                        sendMessage(s,messageTypes.index("FSNETCMD_QUERYAIRSTATE"),0,"III")
-                        self.connected = True
-                        sendMessage(self.sock,37,0,"III") # Get users
-                        self.callback("Logged in!")
-                    
-                    elif mesgType == "FSNETCMD_LISTUSER":
-                        user = parseUser(message[2])
-                        if user['name'] != None:
-                            if type(user['name']) != str : #Could be encoded... Had one or two that were, not all. Weird. maybe if they've got non ascii chars?
-                                user['name'] = user['name'].decode()
-                            tempUser = User(user)
-                            #If it's a valid user, check it's on the list:
-                            if self.userList.getUserByName(user['name']):
-                                if not self.userList.updateUser(tempUser): # Update it, and if it failed, add it
-                                    self.userList.addUser(tempUser)
-                            else: # If it's not on the list, add it.
-                                self.userList.addUser(tempUser)
-                    
-                    elif mesgType == "FSNETCMD_ADDOBJECT":
-                        groundObject = parseGroundObject(message[2])
-                        radarPoint = createRadarPoints(groundObject, self.navTypes)
-                        if radarPoint != None:
-                            self.navPoints[radarPoint["id"]] = NavPoint(radarPoint)
-
-                    elif mesgType == "FSNETCMD_AIRPLANESTATE":
-                        data = parseFlightData(message[2])
-                        userid = data['id']
-                        user = self.userList.getUserByID(userid)
-                        if user:
-                            username = user.name
-                        else:
-                            username = "AI"
-                            user = User()
-
-                        velocity = math.sqrt((data['xspeed']/10)**2 + (data['ySpeed']/10)**2 + (data['zSpeed']/10)**2)*1.94384
-                        horizontal_velocity = math.sqrt((data['xspeed']/10)**2 + (data['zSpeed']/10)**2)*1.94384
-                        if data['zSpeed'] == 0 or data['xspeed'] == 0:
-                            heading = 0
-                        else:
-
-                            heading = math.atan2(data['xspeed']/10,data['zSpeed']/10)*180/math.pi
-                        data['heading'] = heading
-                        data['velocity'] = velocity
-                        data['horizontal_velocity'] = horizontal_velocity
-                        data['username'] = username
-                        
-                        flight = FlightData(data,user)
-                        
-                        if flight.id != 0:
-                            self.planeList[flight.id] = flight
-                    
-                    elif mesgType == "FSNETCMD_REMOVEAIRPLANE":
-                        id = struct.unpack("I",message[2][0:4])[0]
-                        
-                        try:
-                            del self.planeList[id]
-                            del self.userList[id]
-                        except:
+                        while s.recv(4096):
                             pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                elif s is self.sock:
+                    try:
+                        received = self.decoder.fill(s)
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except (OSError, ValueError):
+                        received = 0
+                    if received == 0:
+                        print("Error")
+                        self.callback("Error - Likely disconnected.")
+                        return False
+                    self.handleFrames(time.perf_counter())
+            self.scheduler.runDue()
+
+    def wakeLoop(self):
+        #Only needed when it's not the loop itself queueing things, it'll get round to sending them anyway
+        if self.wakeupWriter is not None and threading.get_ident() != self.loopThread:
+            try:
+                self.wakeupWriter.send(b'\x00')
+            except OSError:
+                pass # Already got a wake up waiting (or we're shutting down), either way that's fine
+
+    def send(self, data):
+        return self.writer.send(data)
+
+    def setSocket(self, sock):
+        self.sock = sock
+        self.inputs = [sock]
+        self.outputs = []
+
+    def startRecording(self, path):
+        #Writes every packet in and out to a capture file at path, until stopRecording is called
+        self.stopRecording()
+        self.recorder = CaptureRecorder(path)
+        self.writer = RecordingSocket(self.writer, self.recorder)
+        return self.recorder
+
+    def stopRecording(self):
+        #Called from disconnect(), so maybe on another thread to the one recording. The recorder's safe to close twice.
+        recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return
+        writer = self.writer
+        if isinstance(writer, RecordingSocket):
+            self.writer = writer.sock
+        recorder.close()
+
+    def startTimers(self):
+        jobs = {"userList": self.checkStayAlive, "airState": self.queryAirState, "sweep": self.sweepStale,
+                "snapshot": self.publish, "conflicts": self.checkConflicts}
+        for name, (interval, jitter) in self.timers.items():
+            self.scheduler.every(name, interval, jobs[name], jitter)
+
+    def setInterval(self, name, interval, jitter=None):
+        #Changes how often one of the timers runs, takes effect straight away if we're connected
+        if jitter is None:
+            jitter = self.timers[name][1]
+        self.timers[name] = (interval, jitter)
+        job = self.scheduler.jobs.get(name)
+        if job is not None:
+            job.interval = interval
+            job.jitter = jitter
+
+    def checkStayAlive(self):
+        if self.connected:
+            self.stayAlive()
+            self.lastStayAlive = time.time()
+
+    def queryAirState(self):
+        if self.connected:
+            sendMessage(self.writer,messageTypes.index("FSNETCMD_QUERYAIRSTATE"),0,"III")
+
+    def sweepStale(self):
+        #Aircraft that have stopped sending (crashed out, or we missed the REMOVEAIRPLANE) would otherwise sit there forever
+        cutoff = time.time() - self.staleTimeout
+        for id in [id for id, flight in self.planeList.items() if flight.lastUpdate < cutoff]:
+            flight = self.planeList.pop(id, None)
+            if flight is not None:
+                self.planeListDirty = True
+                self.planeChanges.remove(id)
+            self.aircraftState.remove(id)
+            self.orphans.pop(id, None)
+        if self.userList.checkUsersAge():
+            self.usersDirty = True
+
+    def checkConflicts(self):
+        #Sends ["STCA", conflicts] to the callback every check while there are any, and once more when they've all cleared
+        if not self.connected:
+            return
+        conflicts = self.conflictDetector.checkStore(self.aircraftState)
+        if conflicts or self.conflicts:
+            self.callback(["STCA", conflicts])
+        self.conflicts = conflicts
 
-                    elif mesgType == "FSNETCMD_REJECTJOINREQ":
-                        print("Rejected")
-                    
-                    elif mesgType == "FSNETCMD_TEXTMESSAGE":
-                        self.callback("Chat: " + message[2].decode())
+    def getConflicts(self):
+        return self.conflicts
+
+    def publish(self):
+        #Makes a new Snapshot if anything's changed since the last one. Call it from the thread that runs the connection.
+        old = self.snapshot
+        if self.navTypesChanged:
+            self.applyNavTypes()
+        if not (self.planesDirty or self.planeListDirty or self.usersDirty or self.navsDirty):
+            return old
+        generation = old.generation + 1
+        planes, state, planesGeneration = old.planes, old.state, old.planesGeneration
+        users, usersGeneration = old.users, old.usersGeneration
+        navPoints, navsGeneration = old.navPoints, old.navsGeneration
+        if self.planeListDirty:
+            planes = MappingProxyType(dict(self.planeList))
+        if self.planesDirty or self.planeListDirty:
+            state = self.aircraftState.snapshot()
+            planesGeneration = generation
+        userChanges = ysstate.emptyDelta
+        if self.usersDirty:
+            users = MappingProxyType(dict(self.userList.byName))
+            usersGeneration = generation
+            userChanges = self.diffUsers(old.users, users)
+        if self.navsDirty:
+            navPoints = MappingProxyType(dict(self.navPoints))
+            navsGeneration = generation
+        changes = ysstate.ChangeSet(generation, self.planeChangesSince(), userChanges, self.navChanges.build())
+        self.navChanges = ysstate.DeltaBuilder()
+        self.planesDirty = self.planeListDirty = self.usersDirty = self.navsDirty = False
+        self.snapshot = Snapshot(generation, time.time(), planes, users, navPoints, state,
+                                 planesGeneration, usersGeneration, navsGeneration,
+                                 (old.changes + (changes,))[-self.changeHistory:])
+        for listener in list(self.snapshotListeners):
+            listener(self.snapshot)
+        return self.snapshot
+
+    def subscribeToSnapshots(self, listener):
+        self.snapshotListeners.append(listener)
+
+    def unsubscribeToSnapshots(self, listener):
+        try:
+            self.snapshotListeners.remove(listener)
+        except ValueError:
+            pass
+
+    def planeChangesSince(self):
+        #Turns what the handlers noted down since the last publish into a Delta, with the fields that changed
+        #The spatial index gets brought up to date here too, it's the same aircraft
+        builder = self.planeChanges
+        fields = self.planeFields
+        moved = []
+        for id in builder.removed:
+            fields.forget(id)
+            self.spatialIndex.remove(id)
+        for id in builder.added:
+            flight = self.planeList.get(id)
+            if flight is not None:
+                fields.set(id, flight)
+                moved.append((id, flight.x, flight.y, flight.z))
+        for id in self.touchedPlanes:
+            if id not in builder.added:
+                flight = self.planeList.get(id)
+                if flight is not None:
+                    builder.update(id, fields.changed(id, flight))
+                    moved.append((id, flight.x, flight.y, flight.z))
+        self.spatialIndex.updateMany(moved)
+        self.touchedPlanes = set()
+        self.planeChanges = ysstate.DeltaBuilder()
+        return builder.build()
+
+    def diffUsers(self, before, after):
+        #There aren't many users, so this just compares the lot
+        builder = ysstate.DeltaBuilder()
+        for name in before:
+            if name not in after:
+                builder.remove(name)
+                self.userFields.forget(name)
+        for name, user in after.items():
+            if name not in before:
+                builder.add(name)
+                self.userFields.set(name, user)
+            else:
+                builder.update(name, self.userFields.changed(name, user))
+        return builder.build()
+
+    def getChanges(self, since, snapshot=None):
+        #One ChangeSet with everything that's changed between generation since and snapshot (the latest if not given).
+        #None if since is too old for the change history to cover, or newer than snapshot (a generation from before a
+        #restart), then start again from snapshot itself.
+        if snapshot is None:
+            snapshot = self.snapshot
+        if since > snapshot.generation:
+            return None
+        if since == snapshot.generation:
+            return ysstate.ChangeSet(snapshot.generation, ysstate.emptyDelta, ysstate.emptyDelta, ysstate.emptyDelta)
+        changes = snapshot.changes
+        if not changes or changes[0].generation > since + 1:
+            return None
+        return ysstate.mergeChanges([change for change in changes if change.generation > since], snapshot.generation)
+
+    def getSnapshot(self):
+        #The latest Snapshot, safe to use from any thread
+        return self.snapshot
+
+    def registerBuiltInHandlers(self):
+        self.registerHandler("FSNETCMD_VERSIONNOTIFY", self.onVersionNotify)
+        self.registerHandler("FSNETCMD_USEMISSILE", self.onUseMissile)
+        self.registerHandler("FSNETCMD_CTRLSHOWUSERNAME", self.onCtrlShowUsername)
+        self.registerHandler("FSNETCMD_USEUNGUIDEDWEAPON", self.onUseUnguidedWeapon)
+        self.registerHandler("FSNETCMD_LOADFIELD", self.onLoadField)
+        self.registerHandler("FSNETCMD_CONFIGSTRING", self.onConfigString)
+        self.registerHandler("FSNETCMD_LIST", self.onList)
+        self.registerHandler("FSNETCMD_PREPARESIMULATION", self.onPrepareSimulation)
+        self.registerHandler("FSNETCMD_ENVIRONMENT", self.onEnvironment)
+        self.registerHandler("FSNETCMD_LOGON", self.onLogon)
+        self.registerHandler("FSNETCMD_LISTUSER", self.onListUser)
+        self.registerHandler("FSNETCMD_ADDOBJECT", self.onAddObject)
+        self.registerHandler("FSNETCMD_REMOVEGROUND", self.onRemoveGround)
+        self.registerHandler("FSNETCMD_AIRPLANESTATE", self.onAirplaneState)
+        self.registerHandler("FSNETCMD_REMOVEAIRPLANE", self.onRemoveAirplane)
+        self.registerHandler("FSNETCMD_REJECTJOINREQ", self.onRejectJoinReq)
+        self.registerHandler("FSNETCMD_TEXTMESSAGE", self.onTextMessage)
+
+    def registerHandler(self, cmd, fn):
+        #Attach fn(socket, message) to a message type. cmd is the FSNETCMD number, or its name from messageTypes.
+        #message is the same (size, type, data) tuple that returnYSMessage gives back. Handlers run in the order they were added.
+        if type(cmd) == str:
+            cmd = messageTypes.index(cmd)
+        self.handlers.setdefault(cmd, []).append(fn)
+        return fn
+
+    register_handler = registerHandler
+
+    def unregisterHandler(self, cmd, fn):
+        if type(cmd) == str:
+            cmd = messageTypes.index(cmd)
+        try:
+            self.handlers[cmd].remove(fn)
+        except (KeyError, ValueError):
+            return False
+        if not self.handlers[cmd]:
+            del self.handlers[cmd]
+        return True
+
+    def handleFrames(self, receivedAt):
+        #Everything complete in the decoder, timing the odd one for the metrics
+        decoder = self.decoder
+        metrics = self.metrics
+        while True:
+            if metrics.sample():
+                start = time.perf_counter()
+                message = decoder.nextFrame()
+                if message is None:
+                    return
+                self.handleMessage(self.writer, message, receivedAt, time.perf_counter() - start)
+            else:
+                message = decoder.nextFrame()
+                if message is None:
+                    return
+                self.handleMessage(self.writer, message)
+
+    def handleMessage(self, s, message, receivedAt=None, decodeTime=None):
+        #receivedAt (perf_counter when the recv finished) and decodeTime are only given when this one's being timed
+        self.messagesReceived += 1
+        self.bytesReceived += message[0] + 4
+        typeMetrics = self.metrics.types.get(message[1]) or self.metrics.forType(message[1])
+        typeMetrics.packets += 1
+        typeMetrics.bytes += message[0] + 4
+        recorder = self.recorder # stopRecording can clear it from another thread (disconnect) at any point
+        if recorder is not None:
+            recorder.record(CAPTURE_IN, message[1], message[2])
+        handlers = self.handlers.get(message[1])
+        if handlers is None:
+            self.unhandledMessages[message[1]] += 1 # Nothing is listening for this type, keep a count so we know what we're missing
+            return
+        if decodeTime is None:
+            for handler in handlers:
+                handler(s, message)
+            return
+        start = time.perf_counter()
+        parseTime = 0.0
+        parser = payloadParsers.get(message[1])
+        if parser is not None:
+            #The handlers parse it again themselves, so that's taken back off their time. Only the sampled ones pay twice.
+            parser(message[2])
+            parseTime = time.perf_counter() - start
+            typeMetrics.parse.observe(parseTime)
+        handlerStart = time.perf_counter()
+        for handler in handlers:
+            handler(s, message)
+        typeMetrics.handler.observe(max(time.perf_counter() - handlerStart - parseTime, 0.0))
+        typeMetrics.decode.observe(decodeTime)
+        if receivedAt is not None:
+            typeMetrics.queue.observe(start - receivedAt)
+
+    def getUnhandledMessages(self):
+        #{type number: count} of everything that came in with no handler registered
+        return dict(self.unhandledMessages)
+
+    def getMetrics(self):
+        #{type name: {"packets", "bytes", "decode", "parse", "handler", "queue"}}, see ysmetrics
+        return self.metrics.snapshot()
+
+    def startMetricsServer(self, port=9464):
+        #Prometheus text on http://127.0.0.1:port/metrics, until stopMetricsServer
+        self.stopMetricsServer()
+        self.metricsServer = ysmetrics.MetricsServer(lambda: [({"server": "%s:%s" % (self.host, self.port)}, self.metrics)], port)
+        return self.metricsServer.port
+
+    def stopMetricsServer(self):
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
+            self.metricsServer = None
+
+    def onVersionNotify(self, s, message):
+        acknowledge(s,9)
+        self.callback("Verifying version")
+
+    def onUseMissile(self, s, message):
+        acknowledge(s,readbacks.index("FSNETREADBACK_USEMISSILE"))
+        self.callback("Verifying missile usage")
+
+    def onCtrlShowUsername(self, s, message):
+        acknowledge(s,readbacks.index("FSNETREADBACK_CTRLSHOWUSERNAME"))
+        self.callback("Verifying username display")
+
+    def onUseUnguidedWeapon(self, s, message):
+        acknowledge(s,readbacks.index("FSNETREADBACK_USEUNGUIDEDWEAPON"))
+        self.callback("Verifying unguided weapon usage")
+
+    def onLoadField(self, s, message):
+        replySame(s,message)
+        try:
+            self.map = message[2].split(b'\x00')[0].decode()
+        except:
+            self.map = "Unknown"
+        self.callback("Verifying map")
+        self.callback(["MAP",self.map])
+
+    def onConfigString(self, s, message):
+        msg_length = len(message[2])
+        sendMessage(s,message[1],message[2],"II"+ str(msg_length) + "s")
+        self.callback("Verifying config")
+
+    def onList(self, s, message):
+        msg_length = len(message[2])
+        sendMessage(s,message[1],message[2],"iI"+str(msg_length) + "s")
+        self.callback("Verifying aircraft list")
+
+    def onPrepareSimulation(self, s, message):
+        acknowledge(s,readbacks.index("FSNETREADBACK_PREPARE"))
+        sendMessage(s,messageTypes.index("FSNETCMD_QUERYAIRSTATE"),0,"III")
+        self.connected = True
+        self.logins += 1
+        sendMessage(s,37,0,"III") # Get users
+        self.callback("Logged in!")
+
+    def onEnvironment(self, s, message):
+        acknowledge(s,readbacks.index("FSNETREADBACK_ENVIRONMENT"))
+        self.callback("Verifying environment")
+        #Parse the packet, and create a weather message to send to the listener. message should be["weather",{"windDirection": windDirection, "windSpeed": windSpeed, "time": time, "visibility": visibility}]
+        if len(message[2])> 8:
+            day, flags, windX, windVert, windZ, visibility = struct.unpack("IIffff",message[2])
+            windSpeed = round(math.sqrt(windX**2 + windZ**2) * 1.94384,2) #Convert to knots
+            windDirection = int(math.degrees(math.atan2(windX,windZ))+180)
+            if day == 1:
+                day = "Day"
+            else:
+                day = "Night"
+            returnMessage = ["weather",{"windDirection": windDirection, "windSpeed": windSpeed, "time": day, "visibility": visibility}]
+            self.callback(returnMessage)
+
+    def onLogon(self, s, message):
+        #Sometimes this is called, sometimes not... Very weird.
+        # Seems to be mainly not called on OpenYS, and ocasionally on 2015xxxx. Have moved the code to prepare, as
+        sendMessage(s,messageTypes.index("FSNETCMD_QUERYAIRSTATE"),0,"III")
+        self.connected = True
+        self.logins += 1
+        sendMessage(s,37,0,"III") # Get users
+        self.callback("Logged in!")
+
+    def onListUser(self, s, message):
+        user = parseUser(message[2])
+        if user['name'] != None:
+            if type(user['name']) != str : #Could be encoded... Had one or two that were, not all. Weird. maybe if they've got non ascii chars?
+                user['name'] = user['name'].decode()
+            tempUser = User(user)
+            #If it's a valid user, check it's on the list:
+            existing = self.userList.getUserByName(user['name'])
+            if existing is not None:
+                #Everyone's listed every few seconds, only a change to what the change feed watches makes a new snapshot
+                before = tuple(getattr(existing, field) for field in userFields)
+                self.userList.updateUser(tempUser)
+                if tuple(getattr(existing, field) for field in userFields) != before:
+                    self.usersDirty = True
+            else: # If it's not on the list, add it.
+                self.userList.addUser(tempUser)
+                self.usersDirty = True
+
+    def onAddObject(self, s, message):
+        #Everything goes in groundObjects, the ground objects that are navs get a NavPoint as well
+        data = message[2]
+        groundObject = decodeGroundObject(data)
+        if groundObject is None:
+            return
+        if self.navTypesChanged:
+            self.applyNavTypes()
+        length = len(data)
+        navType = self.groundObjects.add(groundObject, data[36:100], data[max(length-57, 0):length-1])
+        if navType is None or groundObject.type != 65537: # Not a nav point, so we don't need anything else out of it
+            return
+        radarPoint = createRadarPoint(groundObject, navType, groundObjectName2(data))
+        self.navPoints[radarPoint["id"]] = NavPoint(radarPoint)
+        self.navsDirty = True
+        self.navChanges.add(radarPoint["id"])
+
+    def onRemoveGround(self, s, message):
+        id = struct.unpack("I",message[2][0:4])[0]
+        self.groundObjects.remove(id)
+        if self.navPoints.pop(id, None) is not None:
+            self.navsDirty = True
+            self.navChanges.remove(id)
+
+    def refreshNavPoint(self, id):
+        #Brings navPoints into line with what the matcher now says object id is
+        record = self.groundObjects.get(id)
+        if self.navPoints.pop(id, None) is not None:
+            self.navChanges.remove(id)
+            self.navsDirty = True
+        if record is not None and record.navType is not None and record.type == 65537:
+            self.navPoints[id] = NavPoint(createRadarPoint(record, record.navType, record.label))
+            self.navChanges.add(id)
+            self.navsDirty = True
+
+    def applyNavTypes(self):
+        #Objects we've already got that are (or aren't) navs under the new rules get sorted out from groundObjects,
+        #without needing the map again
+        self.navTypesChanged = False
+        self.navMatcher.update(self.navTypes)
+        for id in self.groundObjects.reclassify():
+            self.refreshNavPoint(id)
+
+    def onAirplaneState(self, s, message):
+        data = decodeAirplaneState(message[2])
+        if data is None or data.id == 0:
+            return
+        user = self.userList.getUserByID(data.id)
+        flight = self.planeList.get(data.id)
+        if user:
+            username = user.name
+        else:
+            username = "AI"
+            if flight is not None and flight.username == "AI":
+                user = flight.user # Already has a stand in, no need for another one
+            else:
+                user = User()
+
+        velocity = math.sqrt((data.xspeed/10)**2 + (data.ySpeed/10)**2 + (data.zSpeed/10)**2)*1.94384
+        horizontal_velocity = math.sqrt((data.xspeed/10)**2 + (data.zSpeed/10)**2)*1.94384
+        if data.zSpeed == 0 or data.xspeed == 0:
+            heading = 0
+        else:
+            heading = math.atan2(data.xspeed/10,data.zSpeed/10)*180/math.pi
+
+        if flight is None:
+            flight = FlightData.fromState(data, user, username, heading, velocity, horizontal_velocity)
+            self.planeList[data.id] = flight
+            self.planeListDirty = True
+            self.planeChanges.add(data.id)
+            if self.orphans:
+                self.adoptOrphan(flight)
+        else:
+            named = flight.username == "AI" and username != "AI" # The user list has caught up with it
+            flight.update(data, user, username, heading, velocity, horizontal_velocity)
+            self.touchedPlanes.add(data.id)
+            if self.orphans:
+                self.orphans.pop(data.id, None)
+                if named:
+                    self.adoptOrphan(flight)
+        self.aircraftState.update(data, flight.lastUpdate)
+        self.planesDirty = True
+
+    def adoptOrphan(self, flight):
+        #A new id after a reconnect (the server's been restarted, most likely). If it's someone we had before, by name,
+        #it keeps the old callsign and flight time and the old id goes. The user list usually turns up after the first
+        #few positions, so it's tried again once we know the name. AI aircraft aren't matched at all: going by position
+        #would hand a parked aircraft's callsign to its neighbour whenever the old ids are coming back too.
+        match = None
+        if flight.username != "AI":
+            for id, orphan in self.orphans.items():
+                if orphan.username == flight.username:
+                    match = id
+                    break
+        if match is None:
+            return False
+        orphan = self.orphans.pop(match)
+        flight.callsign = orphan.callsign
+        flight.startTime = orphan.startTime
+        if self.planeList.get(match) is orphan:
+            del self.planeList[match]
+            self.planeListDirty = True
+            self.planeChanges.remove(match)
+        self.aircraftState.remove(match)
+        return True
+
+    def onRemoveAirplane(self, s, message):
+        id = struct.unpack("I",message[2][0:4])[0]
+        flight = self.planeList.pop(id, None)
+        if flight is not None:
+            self.planeListDirty = True
+            self.planeChanges.remove(id)
+        self.aircraftState.remove(id)
+        self.orphans.pop(id, None)
+
+    def onRejectJoinReq(self, s, message):
+        print("Rejected")
+
+    def onTextMessage(self, s, message):
+        self.callback("Chat: " + message[2].decode())
 
     def disconnect(self):
+        self.closing = True
+        self.stopWaiting.set()
         self.sock.close()
         self.connected = False
+        self.stopRecording()
+        self.wakeLoop() # So it notices the socket's gone
         print("Disconnected")
 
     def getPlanes(self):
@@ -465,7 +1378,7 @@ class YSConnect:
     def stayAlive(self):
         message =struct.pack("II",4,messageTypes.index("FSNETCMD_LISTUSER"))
         self.notFlyingUsers = [] # Clear the userlist, as we'll get a new one in a second
-        self.sock.send(message)
+        self.send(message)
 
     def getUsers(self):
         return self.userList
@@ -474,60 +1387,271 @@ class YSConnect:
         if self.connected:
             message = message.encode()
             message = struct.pack("II",len(message)+13,messageTypes.index("FSNETCMD_TEXTMESSAGE")) + struct.pack("II",0,0) + message + b'\x00'
-            self.sock.send(message)
+            self.send(message)
         
     def updateNavTypes(self, newNavTypes):
+        #Applied on the connection thread, at the next ADDOBJECT or publish, so the rules don't change under a handler
         currentNavs = self.navTypes
         self.navTypes = {**currentNavs, **newNavTypes}
+        self.navTypesChanged = True
+
+    def getGroundObjects(self):
+        return self.groundObjects
+
+
+
+class TransportSocket:
+    #Wraps an asyncio transport so it looks enough like a socket for acknowledge, sendMessage, replySame and friends.
+    #Transports aren't thread safe, so a send from any other thread (the GUI calling sendMessage, say) is handed over
+    #to the loop rather than written there and then. Make it on the loop's thread.
+    def __init__(self, transport, loop):
+        self.transport = transport
+        self.loop = loop
+        self.loopThread = threading.get_ident()
 
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        if threading.get_ident() == self.loopThread:
+            self.transport.write(data)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.transport.write, bytes(data))
+
+    def close(self):
+        self.transport.close()
+
+
+class YSProtocol(asyncio.Protocol):
+    #Hands everything asyncio gives us over to the AsyncYSConnect that owns it
+    def __init__(self, client):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client.connectionMade(transport)
+
+    def data_received(self, data):
+        self.client.dataReceived(data)
+
+    def connection_lost(self, exc):
+        self.client.connectionLost(exc)
+
+
+class AsyncYSConnect(YSConnect):
+    #Same as YSConnect, but runs on an asyncio event loop instead of a blocking socket in its own thread,
+    #so lots of sessions can share one loop. Message handling, handlers and callbacks are all the same as YSConnect.
+    #   await client.connectAsync(host, port) - runs until the connection closes, for use inside a loop
+    #   client.connect(host, port) - blocks like YSConnect.connect does, running its own loop
+    def __init__(self, callback=None):
+        super().__init__(callback)
+        self.transport = None
+        self.loop = None
+        self.closed = None
+        self.closing = False
+        self.stopped = None # Set by disconnect(), cuts short the wait before reconnecting
+        self.timerHandle = None
+
+    def createSocket(self):
+        return None # The transport is made when we connect
+
+    def connect(self, host, port=7915, username="radar", version=20180930):
+        return asyncio.run(self.connectAsync(host, port, username, version))
+
+    async def connectAsync(self, host, port=7915, username="radar", version=20180930):
+        self.username = createLogin(username, version)
+        self.host = host
+        self.port = port
+        self.loop = asyncio.get_running_loop()
+        self.closing = False
+        self.resetSession()
+        self.stopped = asyncio.Event()
+        if not await self.openConnectionAsync():
+            return False
+        attempt = 0
+        while True:
+            logins = self.logins
+            await self.closed
+            if self.closing or not self.autoReconnect:
+                return True
+            if self.logins > logins:
+                attempt = 0
+            while True:
+                if self.reconnectAttempts is not None and attempt >= self.reconnectAttempts:
+                    self.callback("Error - Gave up reconnecting.")
+                    return True
+                delay = self.backoff(attempt)
+                attempt += 1
+                self.callback("Reconnecting in %.1f seconds" % delay)
+                try:
+                    await asyncio.wait_for(self.stopped.wait(), delay)
+                    return True # disconnect() was called
+                except asyncio.TimeoutError:
+                    pass
+                if self.closing:
+                    return True
+                self.resetConnection()
+                if await self.openConnectionAsync(quiet=True):
+                    self.reconnects += 1
+                    break
+
+    async def openConnectionAsync(self, quiet=False):
+        self.closed = self.loop.create_future()
+        try:
+            await self.loop.create_connection(lambda: YSProtocol(self), self.host, self.port)
+        except OSError as msg:
+            print("Connection Failed")
+            if not quiet:
+                self.callback("Connection Failed, have you used the correct address?\n"+str(msg))
+            return False
+        except:
+            print("Connection Failed")
+            if not quiet:
+                self.callback("Connection Failed, have you used the correct port?")
+            return False
+        return True
+
+    def connectionMade(self, transport):
+        self.transport = transport
+        self.sock = TransportSocket(transport, self.loop)
+        self.writer = self.sock
+        recorder = self.recorder
+        if recorder is not None:
+            self.writer = RecordingSocket(self.writer, recorder)
+        self.writer.send(self.username)
+        self.startTimers()
+        self.runTimers()
+
+    def runTimers(self):
+        self.scheduler.runDue()
+        timeout = self.scheduler.timeout()
+        if timeout is not None:
+            self.timerHandle = self.loop.call_later(timeout, self.runTimers)
+
+    def dataReceived(self, data):
+        receivedAt = time.perf_counter()
+        self.decoder.feed(data)
+        self.handleFrames(receivedAt)
+
+    def connectionLost(self, exc):
+        self.connected = False
+        if self.timerHandle is not None:
+            self.timerHandle.cancel()
+            self.timerHandle = None
+        self.scheduler.clear()
+        if not self.closing:
+            print("Error")
+            self.callback("Error - Likely disconnected.")
+        else:
+            self.stopRecording()
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(True)
+
+    def disconnect(self):
+        #Safe to call from any thread, the close itself happens on the loop
+        self.closing = True
+        self.connected = False
+        if self.loop is not None and not self.loop.is_closed():
+            if self.transport is not None:
+                self.loop.call_soon_threadsafe(self.transport.close)
+            if self.stopped is not None:
+                self.loop.call_soon_threadsafe(self.stopped.set)
+        print("Disconnected")
 
 
 class UserList:
+    #Users are kept in dicts by name and by ID, so finding the user for every AIRPLANESTATE doesn't mean going through the lot.
+    #More than one user can have the same ID (everyone not flying, for example), so byID holds {name: user} for each ID,
+    #in the order they were added. Change IDs and names through the list (updateUser, setUserID, renameUser) to keep it in step.
     def __init__(self):
-        self.users = []
+        self.byName = {}
+        self.byID = {}
         self.timeout = 15
     
     def __str__(self):
         return str(self.users)
+
+    def __len__(self):
+        return len(self.byName)
+
+    def __iter__(self):
+        return iter(list(self.byName.values()))
+
+    def __contains__(self, user):
+        return self.byName.get(user.name) is user
+
+    @property
+    def users(self):
+        return list(self.byName.values())
+
+    def indexID(self, user):
+        self.byID.setdefault(user.id, {})[user.name] = user
+
+    def unindexID(self, user):
+        bucket = self.byID.get(user.id)
+        if bucket is not None and bucket.get(user.name) is user:
+            del bucket[user.name]
+            if not bucket:
+                del self.byID[user.id]
     
     def addUser(self, user):
-        self.users.append(user)
+        existing = self.byName.get(user.name)
+        if existing is not None: # Same name, so it's the same person. Replace them.
+            self.removeUser(existing)
+        self.byName[user.name] = user
+        self.indexID(user)
 
     
     def removeUser(self, user):
-        self.users.remove(user)
+        if self.byName.get(user.name) is not user:
+            raise ValueError(str(user) + " is not in the user list")
+        del self.byName[user.name]
+        self.unindexID(user)
     
     def getUserByID(self, id):
-        for user in self.users:
-            if user.id == id:
-                return user
+        bucket = self.byID.get(id)
+        if bucket:
+            return next(iter(bucket.values()))
         return None
     
     def getUserByName(self, name):
-        for user in self.users:
-            if user.name == name:
-                return user
-        return None
+        return self.byName.get(name)
 
     def getUsers(self):
-        self.checkUsersAge()
         return self.users
+
+    def setUserID(self, user, id):
+        if user.id != id:
+            self.unindexID(user)
+            user.id = id
+            self.indexID(user)
+
+    def renameUser(self, user, name):
+        if self.byName.get(user.name) is user:
+            self.removeUser(user)
+            user.name = name
+            self.addUser(user)
+        else:
+            user.name = name
     
     def updateUser(self, user):
-        for i in range(len(self.users)):
-            if self.users[i].name == user.name:
-                self.users[i].setFlying(user.type) # Gets a special one
-                self.users[i].iff = user.iff
-                self.users[i].id = user.id
-                self.users[i].seen()
-                
-                return True
-        return False
+        existing = self.byName.get(user.name)
+        if existing is None:
+            return False
+        existing.setFlying(user.type) # Gets a special one
+        existing.iff = user.iff
+        self.setUserID(existing, user.id)
+        existing.seen()
+        return True
     
     def checkUsersAge(self):
-        for user in self.users:
-            if time.time() - user.lastSeenTime > self.timeout:
-                user.deleteFlag = True
+        #Drops anyone we've not heard from in timeout seconds. Returns whether anyone went.
+        now = time.time()
+        stale = [user for user in self.byName.values() if now - user.lastSeenTime > self.timeout]
+        for user in stale:
+            user.deleteFlag = True
+            self.removeUser(user)
+        return bool(stale)
 
 
 class User:
@@ -618,6 +1742,12 @@ class User:
 
 
 class FlightData:
+    #One per aircraft, updated in place by every AIRPLANESTATE rather than replaced, so the callsign, start time and
+    #whatever the GUI hangs off it (symbol, tableRow, altitudeChange) stay put. Slotted, as there can be a lot of them.
+    __slots__ = ("username","id","x","y","z","heading","velocity","horizontal_velocity","user","startTime","lastUpdate",
+                 "yaw","pitch","roll","xspeed","ySpeed","zSpeed","fuel","callsign","altitude",
+                 "altitudeChange","symbol","tableRow")
+
     def __init__(self, data, user=None):
         #return {"timer":timer,"id":id,"info1":info1,"x":x,"z":z,"y":y,"yaw":yaw,"pitch":pitch,"roll":roll,"xspeed":xspeed,"ySpeed":ySpeed,"zSpeed":zSpeed,"fuel":fuel} + the extra bits added
         self.username = data["username"]
@@ -633,6 +1763,7 @@ class FlightData:
         self.user = user
         #Don't care about the rest for now, but add them for future
         self.startTime = time.time()
+        self.lastUpdate = self.startTime
         self.yaw = data["yaw"]
         self.pitch = data["pitch"]
         self.roll = data["roll"]
@@ -642,6 +1773,50 @@ class FlightData:
         self.fuel = data["fuel"]
         self.callsign= None
         self.altitude = self.getAltitude()
+        self.altitudeChange = 0
+        self.symbol = None
+        self.tableRow = None
+
+    @classmethod
+    def blank(cls):
+        flight = cls.__new__(cls)
+        flight.symbol = None
+        flight.tableRow = None
+        return flight
+
+    @classmethod
+    def fromState(cls, state, user, username, heading, velocity, horizontal_velocity):
+        #Same as __init__, but straight from a decoded AirplaneState without building the dict first
+        flight = cls.blank()
+        flight.start(state, user, username, heading, velocity, horizontal_velocity)
+        return flight
+
+    def start(self, state, user, username, heading, velocity, horizontal_velocity):
+        #Starts the record for a new aircraft. symbol and tableRow are the GUI's, it sets those when it adds the aircraft.
+        self.update(state, user, username, heading, velocity, horizontal_velocity)
+        self.startTime = self.lastUpdate
+        self.callsign = None
+        self.altitude = state.y
+        self.altitudeChange = 0
+
+    def update(self, state, user, username, heading, velocity, horizontal_velocity):
+        self.username = username
+        self.id = state.id
+        self.x = state.x
+        self.y = state.y
+        self.z = state.z
+        self.heading = heading
+        self.velocity = velocity
+        self.horizontal_velocity = horizontal_velocity
+        self.user = user
+        self.lastUpdate = time.time()
+        self.yaw = state.yaw
+        self.pitch = state.pitch
+        self.roll = state.roll
+        self.xspeed = state.xspeed
+        self.ySpeed = state.ySpeed
+        self.zSpeed = state.zSpeed
+        self.fuel = state.fuel
     
     def getPosition(self):
         return (self.x,self.y,self.z)
@@ -0,0 +1,332 @@
+import argparse
+import configparser
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import ysconnect as ys
+import ysmetrics
+import ysstate
+
+#qRadar without Qt: one YSConnect, and a small HTTP API on loopback (or a Unix socket) serving what it knows as JSON,
+#for dashboards, bots and any number of viewers. Run one per server:
+#   python -m ysdaemon ysflight.example.com --port 7915 --listen 8767
+#Endpoints:
+#   /snapshot               everything: planes, users, navs, conflicts, weather
+#   /changes?since=G        what's changed since generation G. If G is too old for the change history, or newer than
+#                           the latest (the daemon's restarted since), it's the whole snapshot again, with "full": true
+#           &wait=S         long poll, holds on up to S seconds (at most 60) for something newer than G
+#   /events[?since=G]       Server-Sent Events: a "snapshot" event, then a "changes" event for every new snapshot
+#   /conflicts, /stats, /metrics (Prometheus text, same as ysmetrics.MetricsServer)
+#The connection thread only ever wakes the waiting requests up. All the encoding happens on the request threads, once
+#per generation however many are asking, so viewers can't slow the ingest down.
+
+jsonSeparators = (",", ":")
+
+def encode(value):
+    return json.dumps(value, separators=jsonSeparators).encode()
+
+def planeRecords(snapshot):
+    #{id: dict} for every plane in snapshot. Numbers come from the snapshot's state array, which is a copy, names from the FlightData.
+    rows = snapshot.state
+    xspeed = rows["xspeed"]/10
+    ySpeed = rows["ySpeed"]/10
+    zSpeed = rows["zSpeed"]/10
+    columns = (rows["id"].tolist(),
+               rows["x"].round(1).tolist(),
+               (rows["y"]*ysstate.M_TO_FT).round().tolist(),
+               rows["z"].round(1).tolist(),
+               ysstate.ysRotationToDegreesFromNorth(rows["yaw"]).tolist(),
+               (np.hypot(xspeed, zSpeed)*ysstate.MS_TO_KNOTS).round(1).tolist(),
+               ySpeed.round(1).tolist(),
+               rows["lastUpdate"].round(3).tolist())
+    planes = snapshot.planes
+    records = {}
+    for id, x, altitude, z, heading, knots, verticalSpeed, lastUpdate in zip(*columns):
+        flight = planes.get(id)
+        if flight is None:
+            continue
+        records[id] = {"id": id, "callsign": flight.getCallsign(), "username": flight.username, "x": x, "z": z,
+                       "altitudeFt": altitude, "heading": heading, "knots": knots, "verticalSpeed": verticalSpeed,
+                       "lastUpdate": lastUpdate}
+    return records
+
+def userRecord(user):
+    return {"name": user.name, "id": user.id, "iff": user.iff, "flying": user.flying,
+            "flyingTime": round(user.getFlyingTime(), 1)}
+
+def navRecord(nav):
+    return {"id": nav.id, "type": nav.type, "name": nav.name, "x": nav.x, "y": nav.y, "z": nav.z, "rotation": nav.rotation}
+
+def deltaRecord(delta, records):
+    #A ysstate.Delta as JSON, with the full record for everything added or updated
+    return {"added": [records[key] for key in delta.added if key in records],
+            "updated": [records[key] for key in delta.updated if key in records],
+            "removed": list(delta.removed)}
+
+
+class StateFeed:
+    #Turns the client's snapshots into JSON, cached by generation, and lets request threads wait for the next one
+    def __init__(self, client):
+        self.client = client
+        self.condition = threading.Condition()
+        self.cacheLock = threading.Lock()
+        self.encodeLock = threading.RLock() # Viewers all wake up together, only one of them does the encoding
+        self.planes = (None, {}) # (planesGeneration, planeRecords)
+        self.snapshotBody = (None, b'') # (generation, encoded snapshot)
+        self.changeBodies = {} # since -> encoded changes, for the latest generation only
+        self.changeGeneration = None
+        self.weather = None
+        self.map = None
+        self.messages = 0
+        self.clients = 0
+        client.subscribeToSnapshots(self.published)
+
+    def published(self, snapshot):
+        #Connection thread
+        with self.condition:
+            self.condition.notify_all()
+
+    def onMessage(self, message):
+        #The client's callback, also on the connection thread
+        self.messages += 1
+        if type(message) == list:
+            if message[0] == "weather":
+                self.weather = message[1]
+            elif message[0] == "MAP":
+                self.map = message[1]
+        elif type(message) == str:
+            print(time.strftime("%H:%M:%S ") + message, flush=True)
+
+    def wait(self, generation, timeout):
+        #The latest snapshot once it's newer than generation, or whatever's latest after timeout seconds. A generation
+        #we haven't got to yet is from before a restart, so that doesn't wait at all.
+        with self.condition:
+            self.condition.wait_for(lambda: self.client.getSnapshot().generation != generation, timeout)
+        return self.client.getSnapshot()
+
+    def planeRecords(self, snapshot):
+        with self.cacheLock:
+            generation, records = self.planes
+            if generation != snapshot.planesGeneration:
+                records = planeRecords(snapshot)
+                self.planes = (snapshot.planesGeneration, records)
+            return records
+
+    def conflicts(self):
+        return [conflict._asdict() for conflict in self.client.getConflicts()]
+
+    def snapshotRecord(self, snapshot):
+        return {"generation": snapshot.generation,
+                "time": snapshot.time,
+                "full": True,
+                "map": self.map,
+                "weather": self.weather,
+                "planes": list(self.planeRecords(snapshot).values()),
+                "users": [userRecord(user) for user in snapshot.users.values()],
+                "navs": [navRecord(nav) for nav in snapshot.navPoints.values()],
+                "conflicts": self.conflicts()}
+
+    def encodeSnapshot(self, snapshot):
+        with self.encodeLock:
+            generation, body = self.snapshotBody
+            if generation != snapshot.generation:
+                body = encode(self.snapshotRecord(snapshot))
+                self.snapshotBody = (snapshot.generation, body)
+            return body
+
+    def encodeChanges(self, since, snapshot):
+        with self.encodeLock:
+            if self.changeGeneration != snapshot.generation:
+                self.changeBodies = {}
+                self.changeGeneration = snapshot.generation
+            body = self.changeBodies.get(since)
+            if body is None:
+                body = self.changesBody(since, snapshot)
+                self.changeBodies[since] = body
+            return body
+
+    def changesBody(self, since, snapshot):
+        changes = self.client.getChanges(since, snapshot)
+        if changes is None:
+            body = self.encodeSnapshot(snapshot)
+        else:
+            users = {name: userRecord(user) for name, user in snapshot.users.items()} if changes.users else {}
+            navs = {id: navRecord(nav) for id, nav in snapshot.navPoints.items()} if changes.navs else {}
+            body = encode({"generation": snapshot.generation,
+                           "since": since,
+                           "time": snapshot.time,
+                           "full": False,
+                           "planes": deltaRecord(changes.planes, self.planeRecords(snapshot)),
+                           "users": deltaRecord(changes.users, users),
+                           "navs": deltaRecord(changes.navs, navs),
+                           "conflicts": self.conflicts()})
+        return body
+
+    def getStats(self):
+        client = self.client
+        snapshot = client.getSnapshot()
+        return {"connected": client.connected,
+                "host": client.host,
+                "port": client.port,
+                "map": self.map,
+                "generation": snapshot.generation,
+                "planes": len(snapshot.planes),
+                "users": len(snapshot.users),
+                "navs": len(snapshot.navPoints),
+                "groundObjects": len(client.groundObjects),
+                "conflicts": len(client.getConflicts()),
+                "conflictCheckMs": round(client.conflictDetector.checkTime*1000, 3),
+                "packets": client.messagesReceived,
+                "reconnects": client.reconnects,
+                "viewers": self.clients}
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class RadarDaemon:
+    #The HTTP side. Listens on loopback (host must be a loopback address, like MetricsServer), or on a Unix socket
+    #if unixPath is given.
+    def __init__(self, client, port=8767, host="127.0.0.1", unixPath=None):
+        if unixPath is None and host not in ysmetrics.MetricsServer.loopbackHosts:
+            raise ValueError("The state API only listens on loopback, not " + host)
+        self.client = client
+        self.feed = StateFeed(client)
+        self.unixPath = unixPath
+        feed = self.feed
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = parse_qs(url.query)
+                try:
+                    since = int(query.get("since", ["0"])[0])
+                    wait = min(float(query.get("wait", ["0"])[0]), 60.0)
+                except ValueError:
+                    self.send_error(400)
+                    return
+                if url.path == "/snapshot":
+                    self.reply(feed.encodeSnapshot(feed.client.getSnapshot()))
+                elif url.path == "/changes":
+                    snapshot = feed.wait(since, wait) if wait > 0 else feed.client.getSnapshot()
+                    self.reply(feed.encodeChanges(since, snapshot))
+                elif url.path == "/events":
+                    self.events(since)
+                elif url.path == "/conflicts":
+                    self.reply(encode(feed.conflicts()))
+                elif url.path == "/stats":
+                    self.reply(encode(feed.getStats()))
+                elif url.path == "/metrics":
+                    self.reply(ysmetrics.renderPrometheus([({"server": str(feed.client.host)}, feed.client.metrics)]).encode(),
+                               "text/plain; version=0.0.4; charset=utf-8")
+                else:
+                    self.send_error(404)
+
+            def reply(self, body, contentType="application/json"):
+                self.send_response(200)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def events(self, since):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                feed.clients += 1
+                try:
+                    snapshot = feed.client.getSnapshot()
+                    if since:
+                        self.wfile.write(b"event: changes\ndata: " + feed.encodeChanges(since, snapshot) + b"\n\n")
+                    else:
+                        self.wfile.write(b"event: snapshot\ndata: " + feed.encodeSnapshot(snapshot) + b"\n\n")
+                    self.wfile.flush()
+                    generation = snapshot.generation
+                    while True:
+                        snapshot = feed.wait(generation, 15)
+                        if snapshot.generation > generation:
+                            self.wfile.write(b"event: changes\ndata: " + feed.encodeChanges(generation, snapshot) + b"\n\n")
+                            generation = snapshot.generation
+                        else:
+                            self.wfile.write(b": still here\n\n")
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    feed.clients -= 1
+
+            def log_message(self, format, *args):
+                pass # Viewers poll, it'd drown out everything else
+
+        if unixPath is not None:
+            if os.path.exists(unixPath):
+                os.unlink(unixPath) # Left over from last time
+            self.httpd = ThreadingUnixHTTPServer(unixPath, Handler)
+            os.chmod(unixPath, 0o600)
+            self.port = None
+        else:
+            self.httpd = ThreadingHTTPServer((host, port), Handler)
+            self.httpd.daemon_threads = True
+            self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.client.unsubscribeToSnapshots(self.feed.published)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        if self.unixPath is not None and os.path.exists(self.unixPath):
+            os.unlink(self.unixPath)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m ysdaemon", description="qRadar with no GUI, serving its state as JSON")
+    parser.add_argument("host", help="YSFlight server to connect to")
+    parser.add_argument("--port", type=int, default=7915, help="YSFlight server port")
+    parser.add_argument("--username", default="radar")
+    parser.add_argument("--version", type=int, default=20180930, help="YSFlight version to log in as")
+    parser.add_argument("--listen", type=int, default=8767, help="port for the state API")
+    parser.add_argument("--bind", default="127.0.0.1", help="loopback address for the state API")
+    parser.add_argument("--unix", help="serve the state API on this Unix socket instead")
+    parser.add_argument("--config", help="qRadar config.ini to take GroundFeatures from")
+    args = parser.parse_args(argv)
+
+    client = ys.YSConnect(print)
+    if args.config:
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        if config.has_option('QRadar', 'GroundFeatures'):
+            client.updateNavTypes(json.loads(config['QRadar']['GroundFeatures']))
+    daemon = RadarDaemon(client, args.listen, args.bind, args.unix)
+    client.callback = daemon.feed.onMessage
+    print("Serving on " + (args.unix if args.unix else "http://%s:%d" % (args.bind, daemon.port)), flush=True)
+    thread = threading.Thread(target=client.connect, args=(args.host, args.port, args.username, args.version), daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if thread.is_alive():
+            client.disconnect()
+            thread.join(5)
+        daemon.stop()
+    return 0 if client.closing else 1 # Stopped by us, rather than gave up
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import re
+import threading
+import numpy as np
+from collections import namedtuple
+
+#Every ground object the server tells us about with FSNETCMD_ADDOBJECT, kept column-wise in one NumPy structured array
+#(one row per object) rather than an object each, as there are thousands of them on a big map. Names are interned: each
+#distinct name is decoded and stored once and the rows just hold its index, and each distinct name is only run past the
+#nav rules once. So buildings, ground traffic, SAMs and navs can all be picked out later without going back to the packets.
+#Positions and attitude are as sent, z is south positive and the angles are radians. positions() flips z for the map.
+
+#The first nine are in the same order as ysconnect.GroundObject, so a row is just the GroundObject with three more on the end
+groundDtype = np.dtype([
+    ("type", np.int32),
+    ("id", np.int32),
+    ("iff", np.int32),
+    ("x", np.float32),
+    ("y", np.float32),
+    ("z", np.float32),
+    ("yaw", np.float32),
+    ("pitch", np.float32),
+    ("roll", np.float32),
+    ("active", np.bool_),
+    ("name", np.int32), # Index into GroundObjectStore.names, the name from the object's .dat, eg HANGAR or ILS
+    ("label", np.int32), # Index into names, what it was called in the scenery editor, eg @HILO for a nav
+])
+
+#Starts with the same fields as ysconnect.GroundObject, so it'll go anywhere one of those does (createRadarPoint)
+GroundRecord = namedtuple("GroundRecord", ["type","id","iff","x","y","z","yaw","pitch","roll","name","label","navType"])
+
+
+class NavMatcher:
+    #Which nav type (ILS, VORDME, NDB) a ground object's name makes it, if any. Rules are {pattern: nav type}, where
+    #the pattern is one of:
+    #   ILS         - exactly that name
+    #   ILS*        - anything starting with ILS, eg a modded ILS[CJAP]
+    #   re:LDA\[.*  - a regular expression, matched from the start of the name
+    #Exact names win, then the longest matching prefix, then the regular expressions in the order they came.
+    #Every distinct name is only matched once, after that it's a dict lookup.
+    def __init__(self, rules=None):
+        self.rules = {}
+        self.update(rules or {})
+
+    def update(self, rules):
+        #Adds to (or overrides) the current rules
+        self.rules = {**self.rules, **rules}
+        exact = {}
+        prefixes = []
+        expressions = []
+        for pattern, navType in self.rules.items():
+            if pattern.startswith("re:"):
+                try:
+                    expressions.append((re.compile(pattern[3:]), navType))
+                except re.error as error:
+                    print("Ignoring nav rule " + pattern + ": " + str(error))
+            elif pattern.endswith("*"):
+                prefixes.append((pattern[:-1], navType))
+            else:
+                exact[pattern] = navType
+        prefixes.sort(key=lambda prefix: len(prefix[0]), reverse=True)
+        self.exact = exact
+        self.prefixes = prefixes
+        self.expressions = expressions
+        self.cache = {}
+
+    def match(self, name):
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        navType = self.exact.get(name)
+        if navType is None:
+            for prefix, prefixType in self.prefixes:
+                if name.startswith(prefix):
+                    navType = prefixType
+                    break
+        if navType is None:
+            for expression, expressionType in self.expressions:
+                if expression.match(name):
+                    navType = expressionType
+                    break
+        self.cache[name] = navType
+        return navType
+
+
+class GroundObjectStore:
+    #Like ysstate.AircraftStateStore, adds are queued up as plain tuples and written into the array in one go when
+    #someone reads it, so an ADDOBJECT only costs a couple of dict lookups on the network thread.
+    def __init__(self, matcher=None, capacity=1024):
+        self.data = np.zeros(capacity, dtype=groundDtype)
+        self.slots = {} # Object id -> row in data
+        self.free = list(range(capacity-1, -1, -1))
+        self.pending = {} # Row -> newest row contents not written to data yet
+        self.names = [] # Interned names, index -> name
+        self.nameIndexes = {} # Raw name bytes -> index
+        self.navTypes = [] # Name index -> nav type, or None if it isn't one
+        self.matcher = matcher if matcher is not None else NavMatcher()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, id):
+        return id in self.slots
+
+    def intern(self, raw):
+        #Index of the name in raw (bytes, null terminated or padded), adding it if it's new
+        index = self.nameIndexes.get(raw)
+        if index is None:
+            try:
+                name = raw.split(b'\x00', 1)[0].decode()
+            except UnicodeDecodeError:
+                name = 'unknown'
+            index = len(self.names)
+            self.names.append(name)
+            self.navTypes.append(self.matcher.match(name))
+            self.nameIndexes[raw] = index
+        return index
+
+    def grow(self):
+        oldCapacity = len(self.data)
+        data = np.zeros(oldCapacity*2, dtype=groundDtype)
+        data[:oldCapacity] = self.data
+        self.data = data
+        self.free = list(range(oldCapacity*2-1, oldCapacity-1, -1)) + self.free
+
+    def add(self, groundObject, rawName, rawLabel=b''):
+        #groundObject is a ysconnect.GroundObject, rawName/rawLabel the name bytes from the packet. Returns its nav type,
+        #or None if it isn't a nav. Adding an id that's already here replaces it.
+        name = self.intern(rawName)
+        label = self.intern(rawLabel)
+        slot = self.slots.get(groundObject.id)
+        if slot is None:
+            if not self.free:
+                self.flush()
+                self.grow()
+            slot = self.free.pop()
+            self.slots[groundObject.id] = slot
+        self.pending[slot] = groundObject + (True, name, label)
+        return self.navTypes[name]
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if pending:
+                self.data[np.fromiter(pending.keys(), dtype=np.intp, count=len(pending))] = np.array(list(pending.values()), dtype=groundDtype)
+
+    def remove(self, id):
+        slot = self.slots.pop(id, None)
+        if slot is None:
+            return False
+        self.pending.pop(slot, None)
+        self.data[slot] = 0
+        self.free.append(slot)
+        return True
+
+    def clear(self):
+        self.data[:] = 0
+        self.slots = {}
+        self.pending = {}
+        self.free = list(range(len(self.data)-1, -1, -1))
+
+    def activeSlots(self):
+        self.flush()
+        return np.flatnonzero(self.data["active"])
+
+    def get(self, id):
+        #A GroundRecord for one object, or None
+        slot = self.slots.get(id)
+        if slot is None:
+            return None
+        self.flush()
+        row = self.data[slot]
+        name = int(row["name"])
+        return GroundRecord(int(row["type"]), int(row["id"]), int(row["iff"]), float(row["x"]), float(row["y"]),
+                            float(row["z"]), float(row["yaw"]), float(row["pitch"]), float(row["roll"]),
+                            self.names[name], self.names[int(row["label"])], self.navTypes[name])
+
+    def snapshot(self):
+        #A read only copy of every active row, names as indexes into self.names
+        rows = self.data[self.activeSlots()]
+        rows.flags.writeable = False
+        return rows
+
+    def positions(self):
+        #Everything needed to draw them, each an array in the same order as "ids". z is flipped, ready for the map.
+        rows = self.data[self.activeSlots()]
+        return {"ids": rows["id"],
+                "type": rows["type"],
+                "iff": rows["iff"],
+                "x": rows["x"],
+                "y": rows["y"],
+                "z": -rows["z"],
+                "heading": np.degrees(rows["yaw"]),
+                "name": rows["name"]}
+
+    def nameIndexesOf(self, name):
+        return [index for index, interned in enumerate(self.names) if interned == name]
+
+    def withName(self, name):
+        #Ids of every object with that name, eg "HANGAR"
+        rows = self.data[self.activeSlots()]
+        return rows["id"][np.isin(rows["name"], self.nameIndexesOf(name))]
+
+    def navIds(self):
+        #Ids of every object the matcher says is a nav
+        rows = self.data[self.activeSlots()]
+        isNav = np.array([navType is not None for navType in self.navTypes], dtype=np.bool_)
+        return rows["id"][isNav[rows["name"]]] if len(isNav) else rows["id"][:0]
+
+    def counts(self):
+        #{name: how many there are}
+        rows = self.data[self.activeSlots()]
+        counts = {}
+        for index, count in enumerate(np.bincount(rows["name"], minlength=len(self.names)).tolist()):
+            if count:
+                name = self.names[index]
+                counts[name] = counts.get(name, 0) + count
+        return counts
+
+    def reclassify(self):
+        #Runs every name past the matcher again (after its rules have changed). Returns the ids of objects whose nav
+        #type is now different.
+        changed = []
+        for index, name in enumerate(self.names):
+            navType = self.matcher.match(name)
+            if navType != self.navTypes[index]:
+                self.navTypes[index] = navType
+                changed.append(index)
+        if not changed:
+            return []
+        rows = self.data[self.activeSlots()]
+        return rows["id"][np.isin(rows["name"], changed)].tolist()
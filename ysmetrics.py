@@ -0,0 +1,172 @@
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+#Per message type counters and timings for YSConnect, so we can see where the time goes on the way in.
+#   client.getMetrics() - {type name: {"packets", "bytes", "decode", "parse", "handler", "queue"}}, the timings as histogram dicts
+#   client.startMetricsServer(9464) - the same as Prometheus text on http://127.0.0.1:9464/metrics
+#Packets and bytes are counted for everything. The timings are only taken for one message in every sampleEvery,
+#a few perf_counter calls for every packet would cost more than the handlers they're measuring.
+#   decode  - cutting the frame out of the receive buffer
+#   parse   - unpacking the payload into fields (decodeAirplaneState, decodeGroundObject, parseUser), for the types
+#             that have one
+#   handler - running every handler registered for the type, less the parse
+#   queue   - from the recv that brought the packet in to its handlers starting, ie waiting behind the rest of the batch
+
+latencyBuckets = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 0.2, 0.5, 1.0)
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=latencyBuckets):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds)+1) # The last one is everything over the top bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        #Upper bound of the bucket the q'th value falls in, so only as good as the buckets are
+        if self.count == 0:
+            return None
+        target = q*self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum/self.count if self.count else None,
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99),
+                "buckets": dict(zip(self.bounds + (float("inf"),), self.counts))}
+
+
+class TypeMetrics:
+    __slots__ = ("packets", "bytes", "decode", "parse", "handler", "queue")
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.decode = Histogram()
+        self.parse = Histogram()
+        self.handler = Histogram()
+        self.queue = Histogram()
+
+
+class MessageMetrics:
+    def __init__(self, typeNames=(), sampleEvery=16):
+        self.typeNames = typeNames
+        self.sampleEvery = sampleEvery # 1 times everything
+        self.types = {}
+        self.tick = 0
+
+    def forType(self, typ):
+        metrics = self.types.get(typ)
+        if metrics is None:
+            metrics = self.types[typ] = TypeMetrics()
+        return metrics
+
+    def sample(self):
+        #Whether the next message should be timed
+        self.tick += 1
+        return self.tick % self.sampleEvery == 0
+
+    def typeName(self, typ):
+        if 0 <= typ < len(self.typeNames):
+            return self.typeNames[typ]
+        return str(typ)
+
+    def reset(self):
+        self.types = {}
+
+    def snapshot(self):
+        return {self.typeName(typ): {"packets": metrics.packets,
+                                     "bytes": metrics.bytes,
+                                     "decode": metrics.decode.snapshot(),
+                                     "parse": metrics.parse.snapshot(),
+                                     "handler": metrics.handler.snapshot(),
+                                     "queue": metrics.queue.snapshot()}
+                for typ, metrics in list(self.types.items())}
+
+
+def labelString(labels):
+    return ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels.items())
+
+def renderPrometheus(sources):
+    #sources is [(labels, MessageMetrics)], eg [({"server": "main"}, client.metrics)]. Returns the text exposition format.
+    lines = []
+    counters = (("ysqradar_packets_total", "Packets received", "packets"),
+                ("ysqradar_bytes_total", "Bytes received, headers included", "bytes"))
+    histograms = (("ysqradar_decode_seconds", "Time to cut the packet out of the receive buffer", "decode"),
+                  ("ysqradar_parse_seconds", "Time to unpack the packet's payload into fields", "parse"),
+                  ("ysqradar_handler_seconds", "Time spent in the handlers for the packet, less the parse", "handler"),
+                  ("ysqradar_queue_seconds", "Time from the packet being received to its handlers starting", "queue"))
+    for name, help, attribute in counters:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s counter" % name)
+        for labels, metrics in sources:
+            for typ, typeMetrics in list(metrics.types.items()):
+                label = labelString({**labels, "type": metrics.typeName(typ)})
+                lines.append("%s{%s} %d" % (name, label, getattr(typeMetrics, attribute)))
+    for name, help, attribute in histograms:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s histogram" % name)
+        for labels, metrics in sources:
+            for typ, typeMetrics in list(metrics.types.items()):
+                histogram = getattr(typeMetrics, attribute)
+                label = labelString({**labels, "type": metrics.typeName(typ)})
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%g"} %d' % (name, label, bound, cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, label, histogram.count))
+                lines.append("%s_sum{%s} %.9f" % (name, label, histogram.sum))
+                lines.append("%s_count{%s} %d" % (name, label, histogram.count))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    #Serves renderPrometheus(source()) at /metrics on its own thread. Loopback only, there's nothing here
+    #anyone else needs to see, and nothing to stop them asking for it as often as they like.
+    loopbackHosts = ("127.0.0.1", "localhost") # ThreadingHTTPServer is IPv4 only, so no ::1
+
+    def __init__(self, source, port=9464, host="127.0.0.1"):
+        if host not in self.loopbackHosts:
+            raise ValueError("The metrics endpoint only listens on loopback, not " + host)
+        self.source = source
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = renderPrometheus(server.source()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Scraped every few seconds, it'd drown out everything else
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
@@ -0,0 +1,124 @@
+import socket
+import threading
+import time
+import ysconnect as ys
+
+#Plays a capture made with YSConnect.startRecording back into a YSConnect, through the same FrameDecoder and handlers a live
+#server would go through. Only the packets the server sent us are replayed, what we sent back is just thrown away.
+#speed is how many times faster than real time to go, 0 (or None) means as fast as possible.
+#
+#   replay = CaptureReplay("server.cap", speed=0)
+#   stats = replay.feed(client) # Straight into the decoder, no sockets involved
+#   stats = replay.runSocketpair(client) # Over a real socket, through YSConnect.connection and its select loop
+
+class NullSocket:
+    #Swallows everything the handlers try to send back to the "server"
+    def send(self, data):
+        return len(data)
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class CaptureReplay:
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.frames = [] # (time in ns, packet with its size and type on the front)
+        for timestamp, direction, typ, payload in ys.readCapture(path):
+            if direction == ys.CAPTURE_IN:
+                self.frames.append((timestamp, ys.headerStruct.pack(len(payload)+4, typ) + payload))
+        self.stopped = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    def stop(self):
+        self.stopped = True
+
+    def paced(self, batchSize=65536):
+        #Yields the packets in chunks of up to batchSize bytes, waiting between them when we're ahead of the capture's own timing
+        if not self.frames:
+            return
+        firstTime = self.frames[0][0]
+        start = time.perf_counter()
+        batch = bytearray()
+        for timestamp, frame in self.frames:
+            if self.stopped:
+                break
+            if self.speed:
+                wait = (timestamp - firstTime)/1e9/self.speed - (time.perf_counter() - start)
+                if wait > 0.001: # Don't bother sleeping for less than a millisecond, just send it with the next lot
+                    if batch:
+                        yield bytes(batch)
+                        batch.clear()
+                    time.sleep(wait)
+            batch += frame
+            if len(batch) >= batchSize:
+                yield bytes(batch)
+                batch.clear()
+        if batch:
+            yield bytes(batch)
+
+    def stats(self, start, end):
+        elapsed = end - start
+        packets = len(self.frames)
+        size = sum(len(frame) for timestamp, frame in self.frames)
+        return {"packets": packets,
+                "bytes": size,
+                "elapsed": elapsed,
+                "packetsPerSecond": packets/elapsed if elapsed else 0,
+                "captureLength": (self.frames[-1][0] - self.frames[0][0])/1e9 if self.frames else 0}
+
+    def feed(self, client):
+        #Pushes the capture straight into client's decoder and handlers on this thread
+        sock = NullSocket()
+        decoder = client.decoder
+        start = time.perf_counter()
+        for chunk in self.paced():
+            decoder.feed(chunk)
+            for message in decoder.frames():
+                client.handleMessage(sock, message)
+        return self.stats(start, time.perf_counter())
+
+    def runSocketpair(self, client):
+        #Runs client.connection() on one end of a socketpair while another thread writes the capture into the other end.
+        #When the capture runs out the socket is closed, so the client will report it's been disconnected.
+        serverSide, clientSide = socket.socketpair()
+        client.setSocket(clientSide)
+        client.username = b'' # Nobody's listening for a login
+        writer = threading.Thread(target=self.writeTo, args=(serverSide,), daemon=True)
+        drainer = threading.Thread(target=self.drain, args=(serverSide,), daemon=True)
+        start = time.perf_counter()
+        drainer.start()
+        writer.start()
+        client.connection()
+        end = time.perf_counter()
+        writer.join()
+        clientSide.close()
+        drainer.join()
+        serverSide.close()
+        return self.stats(start, end)
+
+    def writeTo(self, sock):
+        try:
+            for chunk in self.paced():
+                sock.sendall(chunk)
+        except OSError:
+            pass
+        finally:
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def drain(self, sock):
+        #Read and ignore whatever the client sends, so it never blocks on a full socket
+        try:
+            while sock.recv(65536):
+                pass
+        except OSError:
+            pass
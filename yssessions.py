@@ -0,0 +1,176 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+import ysconnect as ys
+import ysmetrics
+
+#Runs lots of YSFlight server connections at once, all on one asyncio loop in one background thread.
+#Everything that comes back is keyed by (server name, id), so aircraft 3 on one server doesn't collide with aircraft 3 on another.
+
+class Session:
+    def __init__(self, name, host, port=7915, username="radar", version=20180930, callback=None):
+        self.name = name
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.version = version
+        self.callback = callback
+        self.client = ys.AsyncYSConnect(self.incomingMessage)
+        self.future = None
+        self.startTime = None
+        self.lastMessage = None
+
+    def incomingMessage(self, message):
+        self.lastMessage = message
+        if self.callback:
+            self.callback(self.name, message)
+
+    def getStats(self):
+        client = self.client
+        if self.startTime:
+            uptime = time.time() - self.startTime
+        else:
+            uptime = 0
+        return {"host": self.host,
+                "port": self.port,
+                "connected": client.connected,
+                "map": client.map,
+                "uptime": uptime,
+                "messages": client.messagesReceived,
+                "bytes": client.bytesReceived,
+                "messagesPerSecond": client.messagesReceived/uptime if uptime else 0,
+                "planes": len(client.planeList),
+                "users": len(client.userList),
+                "navPoints": len(client.navPoints),
+                "reconnects": client.reconnects,
+                "unhandled": client.getUnhandledMessages(),
+                "lastMessage": self.lastMessage}
+
+
+class SessionManager:
+    #callback is called as callback(server name, message) with the same messages YSConnect sends its callback
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.sessions = {}
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.metricsServer = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.runLoop, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def runLoop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def stop(self, timeout=5):
+        self.stopMetricsServer()
+        sessions = self.getSessions()
+        for session in sessions:
+            self.removeServer(session.name)
+        #Let the connections finish closing before the loop goes away
+        futures = [session.future for session in sessions if session.future is not None]
+        if futures:
+            concurrent.futures.wait(futures, timeout)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+        self.loop = None
+        self.thread = None
+
+    def addServer(self, name, host, port=7915, username="radar", version=20180930):
+        with self.lock:
+            if name in self.sessions:
+                raise ValueError("There's already a server called " + name)
+            session = Session(name, host, port, username, version, self.callback)
+            self.sessions[name] = session
+        self.start()
+        session.startTime = time.time()
+        session.future = asyncio.run_coroutine_threadsafe(session.client.connectAsync(host, session.port, username, version), self.loop)
+        return session
+
+    def removeServer(self, name):
+        with self.lock:
+            session = self.sessions.pop(name, None)
+        if session is None:
+            return False
+        session.client.disconnect()
+        return True
+
+    def getSession(self, name):
+        return self.sessions.get(name)
+
+    def getSessions(self):
+        with self.lock:
+            return list(self.sessions.values())
+
+    def sendMessage(self, message, name=None):
+        #Chat to one server, or all of them if no name is given
+        for session in self.getSessions():
+            if name is None or session.name == name:
+                self.loop.call_soon_threadsafe(session.client.sendMessage, message)
+
+    def updateNavTypes(self, newNavTypes):
+        for session in self.getSessions():
+            session.client.updateNavTypes(newNavTypes)
+
+    def getPlanes(self):
+        #{(server name, aircraft id): FlightData} for every server
+        planes = {}
+        for session in self.getSessions():
+            for id, plane in list(session.client.planeList.items()):
+                planes[(session.name, id)] = plane
+        return planes
+
+    def getUsers(self):
+        #[(server name, User)] for every server
+        users = []
+        for session in self.getSessions():
+            for user in list(session.client.userList.users):
+                users.append((session.name, user))
+        return users
+
+    def getNavPoints(self):
+        #{(server name, nav id): NavPoint} for every server
+        navs = {}
+        for session in self.getSessions():
+            for id, nav in list(session.client.navPoints.items()):
+                navs[(session.name, id)] = nav
+        return navs
+
+    def getConflicts(self):
+        #[(server name, ysstca.Conflict)] for every server. Aircraft on different servers can't be in conflict.
+        conflicts = []
+        for session in self.getSessions():
+            for conflict in session.client.getConflicts():
+                conflicts.append((session.name, conflict))
+        return conflicts
+
+    def getStats(self):
+        return {session.name: session.getStats() for session in self.getSessions()}
+
+    def getMetrics(self):
+        #{server name: client.getMetrics()}
+        return {session.name: session.client.getMetrics() for session in self.getSessions()}
+
+    def startMetricsServer(self, port=9464):
+        #Prometheus text for every server, labelled with its name, on http://127.0.0.1:port/metrics
+        self.stopMetricsServer()
+        self.metricsServer = ysmetrics.MetricsServer(
+            lambda: [({"server": session.name}, session.client.metrics) for session in self.getSessions()], port)
+        return self.metricsServer.port
+
+    def stopMetricsServer(self):
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
+            self.metricsServer = None
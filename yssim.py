@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import math
+import random
+import struct
+import threading
+import time
+import ysconnect as ys
+
+#A pretend YSFlight server for load testing qRadar. It does just enough of the log-in for YSConnect to be happy
+#(VERSIONNOTIFY, LOADFIELD, CONFIGSTRING, LIST, PREPARESIMULATION, answering LISTUSER) and then streams made up
+#AIRPLANESTATE, ADDOBJECT and TEXTMESSAGE traffic at whatever rate you ask for.
+#
+#   python yssim.py --aircraft 500 --rate 10 --duration 20    (load test against YSConnect in this process)
+#   python yssim.py --serve --port 7915                        (just run the server, connect qRadar to it)
+
+def packet(typ, payload=b''):
+    return ys.headerStruct.pack(len(payload)+4, typ) + payload
+
+def makeAirplaneState(id, x, y, z, yaw=0, xspeed=0, ySpeed=0, zSpeed=0, fuel=1000, timer=0, padded=False):
+    #Payload of an FSNETCMD_AIRPLANESTATE, with x/y/z and yaw as YSConnect will see them once decoded
+    info1 = 3 if padded else 1
+    packed = ys.airplaneStateStructs[padded].pack(timer, id, info1, x, y, -z, -yaw, 0, 0, xspeed, ySpeed, zSpeed, fuel)
+    return packed + bytes(8)
+
+def makeUser(id, name, flying=True, iff=0):
+    #Payload of an FSNETCMD_LISTUSER entry
+    return struct.pack("=hhii", 1 if flying else 0, iff, id, 0) + name.encode() + b'\x00'
+
+def makeGroundObject(id, name, name2, x, y, z, yaw=0.0, iff=0):
+    #Payload of an FSNETCMD_ADDOBJECT for a ground object (type 65537)
+    return (struct.pack("=iiiffffff", 65537, id, iff, x, y, z, yaw, 0.0, 0.0) + name.encode().ljust(64, b'\x00')
+            + bytes(16) + name2.encode().ljust(56, b'\x00') + b'\x00')
+
+def makeTextMessage(text):
+    return struct.pack("II", 0, 0) + text.encode() + b'\x00'
+
+
+class SimAircraft:
+    #Flies either a circle or a straight line that wraps around at the edge of the area
+    def __init__(self, id, path="circle", area=50000.0):
+        self.id = id
+        self.name = "SIM%03d" % id
+        self.path = path
+        self.area = area
+        self.altitude = random.uniform(300, 10000)
+        self.speed = random.uniform(80, 250) # m/s
+        self.centreX = random.uniform(-area, area)
+        self.centreZ = random.uniform(-area, area)
+        self.radius = random.uniform(2000, 15000)
+        self.phase = random.uniform(0, 2*math.pi)
+        self.direction = random.uniform(0, 2*math.pi)
+
+    def state(self, t):
+        #(x, y, z, vx, vz) at time t
+        if self.path == "line":
+            vx = math.sin(self.direction)*self.speed
+            vz = math.cos(self.direction)*self.speed
+            x = (self.centreX + vx*t + self.area) % (2*self.area) - self.area
+            z = (self.centreZ + vz*t + self.area) % (2*self.area) - self.area
+        else:
+            angle = self.phase + self.speed*t/self.radius
+            x = self.centreX + math.cos(angle)*self.radius
+            z = self.centreZ + math.sin(angle)*self.radius
+            vx = -math.sin(angle)*self.speed
+            vz = math.cos(angle)*self.speed
+        return x, self.altitude, z, vx, vz
+
+    def packet(self, t, timer):
+        #x/z are map coordinates, where z is flipped, so north is -vz. Speeds go out in 0.1 m/s with z pointing north.
+        x, y, z, vx, vz = self.state(t)
+        yaw = int(math.degrees(math.atan2(vx, -vz))*65536/360)
+        yaw = max(-32768, min(32767, yaw))
+        return packet(11, makeAirplaneState(self.id, x, y, z, yaw, int(vx*10), 0, int(-vz*10), timer=timer))
+
+
+class SimServer:
+    def __init__(self, host="127.0.0.1", port=0, aircraft=50, rate=10.0, path="circle", navs=20, chatInterval=5.0, field="SIM_FIELD"):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.field = field
+        self.chatInterval = chatInterval
+        self.aircraft = [SimAircraft(id, path) for id in range(1, aircraft+1)]
+        self.navs = [makeGroundObject(100000+i, random.choice(["ILS", "VORDME", "NDB"]), "NAV%02d" % i,
+                                      random.uniform(-50000, 50000), 0, random.uniform(-50000, 50000)) for i in range(navs)]
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.packetsSent = 0
+        self.bytesSent = 0
+        self.clients = 0
+        self.tasks = set()
+        self.writers = set()
+
+    def start(self):
+        #Runs the server on its own thread, returns the port it's listening on
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self.port
+
+    def run(self, ready=None):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handleClient, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        if ready:
+            ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+    def stop(self):
+        #Hangs up on everyone, like a real server going down would
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    async def shutdown(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def send(self, writer, data):
+        writer.write(data)
+        self.bytesSent += len(data)
+
+    async def handleClient(self, reader, writer):
+        self.clients += 1
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        self.writers.add(writer)
+        try:
+            size = ys.headerStruct.unpack(await reader.readexactly(8))[0]
+            await reader.readexactly(size-4) # Log-on, we don't care who it is
+            #The log-in, in the order a real server sends it
+            self.send(writer, packet(29, struct.pack("I", 20180930)))
+            self.send(writer, packet(4, self.field.encode().ljust(32, b'\x00') + bytes(28)))
+            self.send(writer, packet(43, b"SIMCONFIG\x00"))
+            self.send(writer, packet(44, struct.pack("=BBxx", 1, 1) + b"SIMAIRCRAFT\x00"))
+            for nav in self.navs:
+                self.send(writer, packet(5, nav))
+            self.send(writer, packet(16))
+            await writer.drain()
+            streamer = asyncio.ensure_future(self.stream(writer))
+            try:
+                while True:
+                    size, typ = ys.headerStruct.unpack(await reader.readexactly(8))
+                    if size > 4:
+                        await reader.readexactly(size-4)
+                    if typ == 37: # LISTUSER, tell them who's "flying"
+                        for aircraft in self.aircraft:
+                            self.send(writer, packet(37, makeUser(aircraft.id, aircraft.name)))
+            finally:
+                streamer.cancel()
+                await asyncio.gather(streamer, return_exceptions=True)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients -= 1
+            self.tasks.discard(task)
+            self.writers.discard(writer)
+            writer.close()
+
+    async def stream(self, writer):
+        start = time.perf_counter()
+        interval = 1/self.rate
+        tick = 0
+        lastChat = start
+        while True:
+            now = time.perf_counter()
+            t = now - start
+            batch = b''.join([aircraft.packet(t, tick) for aircraft in self.aircraft])
+            self.send(writer, batch)
+            self.packetsSent += len(self.aircraft)
+            if self.chatInterval and now - lastChat > self.chatInterval:
+                self.send(writer, packet(32, makeTextMessage("(SIM) tick %d" % tick)))
+                lastChat = now
+            await writer.drain()
+            tick += 1
+            wait = start + tick*interval - time.perf_counter()
+            await asyncio.sleep(max(wait, 0))
+
+
+def loadTest(aircraft=100, rate=10.0, duration=10.0, path="circle"):
+    #Points a YSConnect (on its own thread, like qRadar runs it) at a SimServer and measures how much it keeps up with
+    server = SimServer(aircraft=aircraft, rate=rate, path=path)
+    port = server.start()
+    client = ys.YSConnect(lambda message: None)
+    thread = threading.Thread(target=client.connect, args=("127.0.0.1", port), daemon=True)
+    thread.start()
+    while not client.connected:
+        time.sleep(0.01)
+    startMessages = client.messagesReceived
+    startSent = server.packetsSent
+    start = time.perf_counter()
+    time.sleep(duration)
+    elapsed = time.perf_counter() - start
+    received = client.messagesReceived - startMessages # Includes the user list replies, so it can come out a bit over
+    sent = server.packetsSent - startSent
+    client.disconnect()
+    server.stop()
+    thread.join(5)
+    return {"aircraft": aircraft,
+            "rate": rate,
+            "offered": aircraft*rate,
+            "sentPerSecond": sent/elapsed,
+            "receivedPerSecond": received/elapsed,
+            "planes": len(client.planeList),
+            "users": len(client.userList),
+            "navPoints": len(client.navPoints),
+            "keptUp": received >= sent*0.95}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pretend YSFlight server for load testing qRadar")
+    parser.add_argument("--aircraft", type=int, nargs="+", default=[100], help="Number of aircraft, give several to step through them")
+    parser.add_argument("--rate", type=float, default=10.0, help="Updates per second per aircraft")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run each load test for")
+    parser.add_argument("--path", choices=["circle", "line"], default="circle")
+    parser.add_argument("--serve", action="store_true", help="Just run the server until Ctrl+C")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7915)
+    args = parser.parse_args()
+
+    if args.serve:
+        server = SimServer(args.host, args.port, args.aircraft[0], args.rate, args.path)
+        print("Serving %d aircraft at %gHz on %s:%d" % (args.aircraft[0], args.rate, args.host, args.port))
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        for count in args.aircraft:
+            result = loadTest(count, args.rate, args.duration, args.path)
+            print("%5d aircraft @ %gHz: offered %7d/s, sent %9.0f/s, client handled %9.0f/s %s" % (
+                count, args.rate, result["offered"], result["sentPerSecond"], result["receivedPerSecond"],
+                "" if result["keptUp"] else "<- falling behind"))
@@ -0,0 +1,141 @@
+import heapq
+import math
+import threading
+
+#Uniform grid over the aircraft, for "who's within R of here", "who's nearest here" and "who's in this box" without
+#going through every aircraft. Positions are in metres, in the same x/z as FlightData (z already flipped, so it's the
+#map's frame). Updates only move an aircraft between cells when it crosses into a new one.
+#Safe to query from one thread while another updates it.
+
+NM_TO_M = 1852.0
+
+class SpatialIndex:
+    def __init__(self, cellSize=5*NM_TO_M):
+        self.cellSize = cellSize
+        self.cells = {} # (cx, cz) -> {id: (x, y, z)}
+        self.positions = {} # id -> (x, y, z, cell)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, id):
+        return id in self.positions
+
+    def cellOf(self, x, z):
+        return (math.floor(x/self.cellSize), math.floor(z/self.cellSize))
+
+    def update(self, id, x, y, z):
+        with self.lock:
+            self.updateLocked(id, x, y, z)
+
+    def updateMany(self, items):
+        #items is (id, x, y, z) for each aircraft, all under one lock
+        with self.lock:
+            for id, x, y, z in items:
+                self.updateLocked(id, x, y, z)
+
+    def updateLocked(self, id, x, y, z):
+        cell = (math.floor(x/self.cellSize), math.floor(z/self.cellSize))
+        old = self.positions.get(id)
+        if old is not None and old[3] != cell:
+            self.dropFromCell(id, old[3])
+        self.cells.setdefault(cell, {})[id] = (x, y, z)
+        self.positions[id] = (x, y, z, cell)
+
+    def dropFromCell(self, id, cell):
+        members = self.cells[cell]
+        del members[id]
+        if not members:
+            del self.cells[cell]
+
+    def remove(self, id):
+        with self.lock:
+            old = self.positions.pop(id, None)
+            if old is not None:
+                self.dropFromCell(id, old[3])
+            return old is not None
+
+    def clear(self):
+        with self.lock:
+            self.cells = {}
+            self.positions = {}
+
+    def get(self, id):
+        #(x, y, z) of id, or None
+        position = self.positions.get(id)
+        return position[:3] if position is not None else None
+
+    def inBox(self, minX, minZ, maxX, maxZ):
+        #[id] for everything with minX <= x <= maxX and minZ <= z <= maxZ
+        found = []
+        with self.lock:
+            cells = self.cells
+            minCX, minCZ = self.cellOf(minX, minZ)
+            maxCX, maxCZ = self.cellOf(maxX, maxZ)
+            if (maxCX - minCX + 1)*(maxCZ - minCZ + 1) > len(cells): # Huge box, quicker to go through the cells there are
+                candidates = [members for cell, members in cells.items() if minCX <= cell[0] <= maxCX and minCZ <= cell[1] <= maxCZ]
+            else:
+                candidates = [cells[(cx, cz)] for cx in range(minCX, maxCX+1) for cz in range(minCZ, maxCZ+1) if (cx, cz) in cells]
+            for members in candidates:
+                for id, (x, y, z) in members.items():
+                    if minX <= x <= maxX and minZ <= z <= maxZ:
+                        found.append(id)
+        return found
+
+    def withinRange(self, x, z, radius):
+        #[(distance, id)] for everything within radius metres of x, z (horizontally), nearest first
+        found = []
+        radiusSquared = radius*radius
+        with self.lock:
+            cells = self.cells
+            minCX, minCZ = self.cellOf(x - radius, z - radius)
+            maxCX, maxCZ = self.cellOf(x + radius, z + radius)
+            if (maxCX - minCX + 1)*(maxCZ - minCZ + 1) > len(cells):
+                candidates = [members for cell, members in cells.items() if minCX <= cell[0] <= maxCX and minCZ <= cell[1] <= maxCZ]
+            else:
+                candidates = [cells[(cx, cz)] for cx in range(minCX, maxCX+1) for cz in range(minCZ, maxCZ+1) if (cx, cz) in cells]
+            for members in candidates:
+                for id, (px, py, pz) in members.items():
+                    distanceSquared = (px-x)**2 + (pz-z)**2
+                    if distanceSquared <= radiusSquared:
+                        found.append((math.sqrt(distanceSquared), id))
+        found.sort()
+        return found
+
+    def nearest(self, x, z, k=1, maxDistance=float("inf")):
+        #[(distance, id)] for the k nearest to x, z within maxDistance metres, nearest first.
+        #Works outwards a ring of cells at a time, and stops once nothing further out could beat what it's got.
+        best = []
+        with self.lock:
+            if not self.positions:
+                return []
+            cells = self.cells
+            size = self.cellSize
+            cx, cz = self.cellOf(x, z)
+            ring = 0
+            while True:
+                if (2*ring+1)**2 > 4*len(cells): # Mostly empty cells from here on (or k is more than there are), just check the lot
+                    best = heapq.nsmallest(k, ((math.sqrt((px-x)**2 + (pz-z)**2), id) for id, (px, py, pz, cell) in self.positions.items()))
+                    return [item for item in best if item[0] <= maxDistance]
+                if ring == 0:
+                    ringCells = [(cx, cz)]
+                else:
+                    ringCells = [(cx + dx, cz - ring) for dx in range(-ring, ring+1)] + [(cx + dx, cz + ring) for dx in range(-ring, ring+1)]
+                    ringCells += [(cx - ring, cz + dz) for dz in range(-ring+1, ring)] + [(cx + ring, cz + dz) for dz in range(-ring+1, ring)]
+                for cell in ringCells:
+                    members = cells.get(cell)
+                    if members:
+                        for id, (px, py, pz) in members.items():
+                            distance = math.sqrt((px-x)**2 + (pz-z)**2)
+                            if distance <= maxDistance:
+                                best.append((distance, id))
+                if best:
+                    best.sort()
+                    del best[k:]
+                #Anything in the next ring out is at least this far away
+                reach = ring*size + min(x - cx*size, (cx+1)*size - x, z - cz*size, (cz+1)*size - z)
+                if (len(best) >= k and best[-1][0] <= reach) or reach > maxDistance:
+                    break
+                ring += 1
+        return best
@@ -0,0 +1,362 @@
+import threading
+import time
+import numpy as np
+from collections import namedtuple
+
+#Aircraft state kept column-wise in one NumPy structured array, one row ("slot") per aircraft, so the display can work
+#out speeds, flight levels, headings etc for everyone in one go instead of one aircraft at a time.
+#Units are as they come off the wire: metres, YS angle units (65536 to a circle), and speeds in 0.1 m/s.
+
+aircraftDtype = np.dtype([
+    ("id", np.int64),
+    ("active", np.bool_),
+    ("x", np.float32),
+    ("y", np.float32), # Altitude
+    ("z", np.float32),
+    ("yaw", np.int32), # Negated when decoded, so the wire's -32768 (due south) comes out as 32768
+    ("pitch", np.int16),
+    ("roll", np.int16),
+    ("xspeed", np.int16),
+    ("ySpeed", np.int16),
+    ("zSpeed", np.int16),
+    ("fuel", np.int16),
+    ("timer", np.uint32),
+    ("firstSeen", np.float64),
+    ("lastUpdate", np.float64),
+])
+
+MS_TO_KNOTS = 1.94384
+M_TO_FT = 3.28084
+
+def ysRotationToDegreesFromNorth(yaw):
+    #Array version of ysconnect.ysRotationToDegreesFromNorth(fp.uuToDegrees(yaw))
+    degrees = np.trunc(np.asarray(yaw, dtype=np.float64)*0.0054931640625)
+    return np.where(degrees < 0, 360 + degrees, degrees)
+
+
+class TrackHistory:
+    #The last `length` positions of every slot, in one preallocated array, so memory stays the same however long things run.
+    #Each row is twice as long as it needs to be and every point is written in both halves, which means the newest
+    #k points are always one contiguous run and last() can hand back a view instead of a copy.
+    #Each point is (x, y, z, time). Points closer together than minInterval seconds are skipped.
+    def __init__(self, capacity=256, length=120, minInterval=1.0):
+        self.length = length
+        self.minInterval = minInterval
+        self.points = np.zeros((capacity, 2*length, 4), dtype=np.float64)
+        self.head = [-1]*capacity # Index of the newest point in each slot, -1 for none
+        self.count = [0]*capacity
+        self.lastTime = [float("-inf")]*capacity
+        self.pending = []
+        self.flushSize = 4096 # Write out once this many points have queued up, even if nobody's reading
+        self.lock = threading.Lock() # Network thread and GUI can both end up flushing
+
+    def grow(self, capacity):
+        self.flush()
+        oldCapacity = len(self.points)
+        points = np.zeros((capacity, 2*self.length, 4), dtype=np.float64)
+        points[:oldCapacity] = self.points
+        self.points = points
+        extra = capacity - oldCapacity
+        self.head += [-1]*extra
+        self.count += [0]*extra
+        self.lastTime += [float("-inf")]*extra
+
+    def append(self, slot, x, y, z, t):
+        if t - self.lastTime[slot] < self.minInterval:
+            return False
+        self.lastTime[slot] = t
+        self.pending.append((slot, x, y, z, t))
+        if len(self.pending) >= self.flushSize:
+            self.flush()
+        return True
+
+    def flush(self):
+        with self.lock:
+            self.flushLocked()
+
+    def flushLocked(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        head = self.head
+        count = self.count
+        length = self.length
+        slots = []
+        indexes = []
+        for point in pending:
+            slot = point[0]
+            index = (head[slot] + 1) % length
+            head[slot] = index
+            if count[slot] < length:
+                count[slot] += 1
+            slots.append(slot)
+            indexes.append(index)
+        slots = np.array(slots, dtype=np.intp)
+        indexes = np.array(indexes, dtype=np.intp)
+        values = np.array(pending, dtype=np.float64)[:, 1:]
+        self.points[slots, indexes] = values
+        self.points[slots, indexes + length] = values
+
+    def reset(self, slot):
+        self.flush()
+        self.head[slot] = -1
+        self.count[slot] = 0
+        self.lastTime[slot] = float("-inf")
+
+    def last(self, slot, k=None):
+        #The newest k points (or all we've got), oldest first, as an (n, 4) view of x, y, z, time. Don't hang on to it,
+        #it'll change as new points come in.
+        self.flush()
+        n = self.count[slot]
+        if k is not None:
+            n = min(k, n)
+        end = self.head[slot] + self.length + 1
+        return self.points[slot, end-n:end]
+
+    def nbytes(self):
+        return self.points.nbytes
+
+
+class AircraftStateStore:
+    #Updates are queued up as plain tuples and written into the array in one go when someone reads it (flush), so an
+    #AIRPLANESTATE only costs a dict assignment on the network thread.
+    def __init__(self, capacity=256, climbThreshold=2.5, historyLength=120, historyInterval=1.0):
+        self.data = np.zeros(capacity, dtype=aircraftDtype)
+        self.history = TrackHistory(capacity, historyLength, historyInterval)
+        self.slots = {} # Aircraft id -> row in data
+        self.free = list(range(capacity-1, -1, -1)) # Rows not in use, lowest at the end so they get used first
+        self.firstSeen = {} # Row -> when that aircraft turned up
+        self.pending = {} # Row -> newest row contents not written to data yet
+        self.climbThreshold = climbThreshold # m/s of vertical speed before we call it climbing/descending
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, id):
+        return id in self.slots
+
+    def grow(self):
+        oldCapacity = len(self.data)
+        data = np.zeros(oldCapacity*2, dtype=aircraftDtype)
+        data[:oldCapacity] = self.data
+        self.data = data
+        self.history.grow(oldCapacity*2)
+        self.free = list(range(oldCapacity*2-1, oldCapacity-1, -1)) + self.free
+
+    def slotOf(self, id):
+        return self.slots.get(id)
+
+    def update(self, state, now=None):
+        #state is a ysconnect.AirplaneState. Returns the slot it went in.
+        if now is None:
+            now = time.time()
+        slot = self.slots.get(state.id)
+        if slot is None:
+            if not self.free:
+                self.flush()
+                self.grow()
+            slot = self.free.pop()
+            self.slots[state.id] = slot
+            self.firstSeen[slot] = now
+        self.pending[slot] = (state.id, True, state.x, state.y, state.z, state.yaw, state.pitch, state.roll,
+                              state.xspeed, state.ySpeed, state.zSpeed, state.fuel, state.timer, self.firstSeen[slot], now)
+        self.history.append(slot, state.x, state.y, state.z, now)
+        return slot
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if pending:
+                self.data[np.fromiter(pending.keys(), dtype=np.intp, count=len(pending))] = np.array(list(pending.values()), dtype=aircraftDtype)
+
+    def remove(self, id):
+        slot = self.slots.pop(id, None)
+        if slot is None:
+            return False
+        self.pending.pop(slot, None)
+        self.firstSeen.pop(slot, None)
+        self.data[slot] = 0
+        self.history.reset(slot)
+        self.free.append(slot)
+        return True
+
+    def clear(self):
+        self.data[:] = 0
+        self.slots = {}
+        self.firstSeen = {}
+        self.pending = {}
+        self.free = list(range(len(self.data)-1, -1, -1))
+        for slot in range(len(self.data)):
+            self.history.reset(slot)
+
+    def track(self, id, k=None):
+        #Recent positions for one aircraft, see TrackHistory.last
+        slot = self.slots.get(id)
+        if slot is None:
+            return None
+        return self.history.last(slot, k)
+
+    def activeSlots(self):
+        self.flush()
+        return np.flatnonzero(self.data["active"])
+
+    def snapshot(self):
+        #A read only copy of every active row, for handing to another thread. Copied as raw records, numpy is much
+        #slower picking rows out of a packed structured array a field at a time.
+        raw = self.data.view(np.dtype((np.void, self.data.dtype.itemsize)))
+        rows = raw[self.activeSlots()].view(self.data.dtype)
+        rows.flags.writeable = False
+        return rows
+
+    def get(self, id):
+        #A copy of one aircraft's row, or None
+        slot = self.slots.get(id)
+        if slot is None:
+            return None
+        self.flush()
+        return self.data[slot].copy()
+
+    def derived(self, now=None):
+        #Everything the display wants, for every aircraft at once. See deriveRows, plus "slots".
+        slots = self.activeSlots()
+        derived = deriveRows(self.data[slots], now, self.climbThreshold)
+        derived["slots"] = slots
+        return derived
+
+    def extrapolate(self, now=None, maxAge=5.0):
+        #Where everyone should be by now, see extrapolateRows, plus "slots"
+        slots = self.activeSlots()
+        predicted = extrapolateRows(self.data[slots], now, maxAge)
+        predicted["slots"] = slots
+        return predicted
+
+
+#These work on any array of aircraftDtype rows, so another thread can use them on a snapshot() (or Snapshot.state)
+#without going near the store itself.
+def deriveRows(rows, now=None, climbThreshold=2.5):
+    #Each entry is an array in the same order as "ids". climbThreshold is the m/s of vertical speed before we call it
+    #climbing/descending.
+    if now is None:
+        now = time.time()
+    xspeed = rows["xspeed"].astype(np.float64)/10
+    ySpeed = rows["ySpeed"].astype(np.float64)/10
+    zSpeed = rows["zSpeed"].astype(np.float64)/10
+    groundSpeed = np.hypot(xspeed, zSpeed)
+    trend = np.zeros(len(rows), dtype=np.int8)
+    trend[ySpeed > climbThreshold] = 1
+    trend[ySpeed < -climbThreshold] = -1
+    return {"ids": rows["id"],
+            "x": rows["x"],
+            "y": rows["y"],
+            "z": rows["z"],
+            "knots": groundSpeed*MS_TO_KNOTS,
+            "trueAirspeedKnots": np.sqrt(xspeed**2 + ySpeed**2 + zSpeed**2)*MS_TO_KNOTS,
+            "flightLevel": np.floor(rows["y"]*M_TO_FT/100).astype(np.int32),
+            "altitudeFt": rows["y"]*M_TO_FT,
+            "heading": ysRotationToDegreesFromNorth(rows["yaw"]),
+            "track": np.degrees(np.arctan2(xspeed, zSpeed)) % 360,
+            "verticalSpeed": ySpeed,
+            "trend": trend,
+            "age": now - rows["lastUpdate"]}
+
+def extrapolateRows(rows, now=None, maxAge=5.0):
+    #Dead reckoning: where everyone should be by now, going by their last position, speed components and how old
+    #that report is. Reports older than maxAge seconds are only carried forward maxAge seconds, and flagged as stale.
+    #x/y/z are in the same frame as the decoded positions (z already flipped), so they can go straight on the map.
+    if now is None:
+        now = time.time()
+    age = now - rows["lastUpdate"]
+    seconds = np.clip(age, 0, maxAge)
+    return {"ids": rows["id"],
+            "x": rows["x"] + rows["xspeed"]/10*seconds,
+            "y": rows["y"] + rows["ySpeed"]/10*seconds,
+            "z": rows["z"] - rows["zSpeed"]/10*seconds, # zSpeed is north, z is flipped
+            "age": age,
+            "stale": age > maxAge}
+
+
+#Change feed. Every time YSConnect publishes a snapshot it also works out what changed since the last one, as a ChangeSet
+#holding a Delta each for planes, users and navs. A Delta is:
+#   added   - ids that are new (for the GUI to build from scratch, so they aren't in updated as well)
+#   updated - {id: frozenset of the fields that changed}
+#   removed - ids that have gone. An id can be both removed and added (gone and come back, maybe as someone else),
+#             so apply removed before added.
+Delta = namedtuple("Delta", ["added", "updated", "removed"])
+ChangeSet = namedtuple("ChangeSet", ["generation", "planes", "users", "navs"])
+emptyDelta = Delta(frozenset(), {}, frozenset())
+
+class DeltaBuilder:
+    #Collects adds, updates and removes, in order, into one Delta. Also used to merge several Deltas together.
+    def __init__(self):
+        self.added = set()
+        self.updated = {}
+        self.removed = set()
+
+    def __bool__(self):
+        return bool(self.added or self.updated or self.removed)
+
+    def add(self, id):
+        self.added.add(id)
+        self.updated.pop(id, None)
+
+    def update(self, id, fields):
+        if fields and id not in self.added:
+            self.updated[id] = self.updated.get(id, frozenset()) | fields
+
+    def remove(self, id):
+        if id in self.added:
+            self.added.discard(id) # Came and went, unless it was here before that as well, then it's still in removed
+        else:
+            self.removed.add(id)
+        self.updated.pop(id, None)
+
+    def merge(self, delta):
+        for id in delta.removed:
+            self.remove(id)
+        for id in delta.added:
+            self.add(id)
+        for id, fields in delta.updated.items():
+            self.update(id, fields)
+
+    def build(self):
+        if not self:
+            return emptyDelta
+        return Delta(frozenset(self.added), self.updated, frozenset(self.removed))
+
+
+class FieldTracker:
+    #Remembers the last published value of some fields of each object, to tell which of them have changed since.
+    #Only the objects it's asked about get looked at, so the work goes with how much changed rather than how much there is.
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.values = {}
+
+    def read(self, item):
+        return tuple(getattr(item, field) for field in self.fields)
+
+    def set(self, id, item):
+        self.values[id] = self.read(item)
+
+    def changed(self, id, item):
+        current = self.read(item)
+        previous = self.values.get(id)
+        self.values[id] = current
+        if previous is None:
+            return frozenset(self.fields)
+        if previous == current:
+            return frozenset()
+        return frozenset(field for field, old, new in zip(self.fields, previous, current) if old != new)
+
+    def forget(self, id):
+        self.values.pop(id, None)
+
+
+def mergeChanges(changes, generation):
+    #One ChangeSet covering all of changes (oldest first), labelled with generation
+    planes, users, navs = DeltaBuilder(), DeltaBuilder(), DeltaBuilder()
+    for change in changes:
+        planes.merge(change.planes)
+        users.merge(change.users)
+        navs.merge(change.navs)
+    return ChangeSet(generation, planes.build(), users.build(), navs.build())
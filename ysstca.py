@@ -0,0 +1,157 @@
+import time
+import numpy as np
+from collections import namedtuple
+import ysstate
+
+#Short term conflict alert. Every tick it takes everyone's position and velocity from the AircraftStateStore and
+#finds the pairs that will lose separation (separationNm horizontally AND separationFt vertically, at the same time)
+#within the next lookahead seconds, flying straight on as they are.
+#Two steps, both NumPy over every aircraft at once:
+#   pruning - each aircraft's path over the lookahead is boxed and dropped into a grid, and only pairs that share a cell
+#             go any further. Aircraft a long way apart never get paired up.
+#   CPA     - for each candidate pair, the times horizontal and vertical separation are lost are solved for exactly
+#             (a quadratic and a linear), and where those overlap is the conflict.
+#Aircraft going slower than minKnots are left out, they're on the ground and would be in conflict with the whole apron.
+
+NM_TO_M = 1852.0
+FT_TO_M = 0.3048
+
+#first/second are aircraft ids (first < second). Times are seconds from now, timeToConflict is 0 if they've already
+#lost separation. closestNm/closestFt are at the closest point of approach, separationNm/separationFt are now.
+Conflict = namedtuple("Conflict", ["first", "second", "timeToConflict", "timeToClosest", "closestNm", "closestFt",
+                                   "separationNm", "separationFt"])
+
+class ConflictDetector:
+    def __init__(self, separationNm=5.0, separationFt=1000.0, lookahead=120.0, cellSizeNm=20.0, minKnots=50.0, maxAge=5.0):
+        self.separationNm = separationNm
+        self.separationFt = separationFt
+        self.lookahead = lookahead
+        self.cellSize = cellSizeNm*NM_TO_M # Around the distance flown in lookahead, so a path is only a few cells
+        self.minKnots = minKnots
+        self.maxAge = maxAge # Reports older than this aren't trusted to still be flying straight, see extrapolate
+        self.conflicts = ()
+        #From the last check, to see how well the pruning's doing
+        self.aircraft = 0
+        self.candidates = 0
+        self.checkTime = 0.0
+
+    def checkStore(self, store, now=None):
+        #Everyone in an AircraftStateStore, dead reckoned up to now. Not thread safe against updates to the store, so
+        #call it from whichever thread is feeding it.
+        start = time.perf_counter()
+        state = store.extrapolate(now, self.maxAge)
+        rows = store.data[state["slots"]]
+        velocity = np.empty((len(rows), 3))
+        velocity[:, 0] = rows["xspeed"]/10
+        velocity[:, 1] = rows["ySpeed"]/10
+        velocity[:, 2] = rows["zSpeed"]/-10 # zSpeed is north, z is flipped. Divided first, -32768 won't negate as an int16
+        position = np.column_stack((state["x"], state["y"], state["z"])).astype(np.float64)
+        flying = ~state["stale"] & (np.hypot(velocity[:, 0], velocity[:, 2])*ysstate.MS_TO_KNOTS >= self.minKnots)
+        conflicts = self.check(state["ids"][flying], position[flying], velocity[flying])
+        self.checkTime = time.perf_counter() - start
+        return conflicts
+
+    def check(self, ids, position, velocity):
+        #position and velocity are (n, 3) arrays of x, y (up), z in metres and m/s. Returns a tuple of Conflicts,
+        #soonest first.
+        self.aircraft = len(ids)
+        first, second = self.candidatePairs(position, velocity)
+        self.candidates = len(first)
+        conflicts = ()
+        if len(first):
+            conflicts = self.closestApproach(np.asarray(ids), position, velocity, first, second)
+        self.conflicts = conflicts
+        return conflicts
+
+    def candidatePairs(self, position, velocity):
+        #(first, second) index arrays, first < second, of every pair whose paths over the lookahead could come within
+        #separation of each other
+        count = len(position)
+        if count < 2:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        half = self.separationNm*NM_TO_M/2
+        end = position + velocity*self.lookahead
+        low = np.minimum(position, end)
+        high = np.maximum(position, end)
+        size = self.cellSize
+        cellX0 = np.floor((low[:, 0] - half)/size).astype(np.int64)
+        cellX1 = np.floor((high[:, 0] + half)/size).astype(np.int64)
+        cellZ0 = np.floor((low[:, 2] - half)/size).astype(np.int64)
+        cellZ1 = np.floor((high[:, 2] + half)/size).astype(np.int64)
+        #One entry for every cell each path's box touches
+        wide = cellZ1 - cellZ0 + 1
+        cells = (cellX1 - cellX0 + 1)*wide
+        owner = np.repeat(np.arange(count), cells)
+        within = np.arange(len(owner)) - np.repeat(np.cumsum(cells) - cells, cells)
+        wide = np.repeat(wide, cells)
+        cellX = np.repeat(cellX0, cells) + within//wide
+        cellZ = np.repeat(cellZ0, cells) + within%wide
+        keys = cellX*(1 << 32) + (cellZ & 0xffffffff)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        owner = owner[order]
+        #Pair every entry with the ones after it in the same cell
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        sizes = np.diff(np.append(starts, len(keys)))
+        partners = np.repeat(starts + sizes, sizes) - np.arange(len(keys)) - 1
+        entry = np.repeat(np.arange(len(keys)), partners)
+        other = entry + 1 + np.arange(len(entry)) - np.repeat(np.cumsum(partners) - partners, partners)
+        a = owner[entry]
+        b = owner[other]
+        #The same pair can share more than one cell
+        pairs = np.sort(np.minimum(a, b)*count + np.maximum(a, b))
+        if len(pairs):
+            pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))] # np.unique, but it can be very slow on these
+        first = pairs//count
+        second = pairs%count
+        #And no point solving for pairs that can't get close enough in altitude
+        vertical = self.separationFt*FT_TO_M
+        keep = (low[first, 1] - vertical < high[second, 1]) & (low[second, 1] - vertical < high[first, 1])
+        return first[keep], second[keep]
+
+    def closestApproach(self, ids, position, velocity, first, second):
+        horizontal = self.separationNm*NM_TO_M
+        vertical = self.separationFt*FT_TO_M
+        lookahead = self.lookahead
+        d = position[second] - position[first]
+        w = velocity[second] - velocity[first]
+        dx, dy, dz = d[:, 0], d[:, 1], d[:, 2]
+        wx, wy, wz = w[:, 0], w[:, 1], w[:, 2]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            #Horizontally inside separation while |d + wt|^2 < horizontal^2
+            a = wx*wx + wz*wz
+            b = 2*(dx*wx + dz*wz)
+            c = dx*dx + dz*dz - horizontal*horizontal
+            discriminant = b*b - 4*a*c
+            root = np.sqrt(np.maximum(discriminant, 0))
+            closing = a > 1e-9
+            horizontalStart = np.where(closing, (-b - root)/(2*a), -np.inf)
+            horizontalEnd = np.where(closing, (-b + root)/(2*a), np.inf)
+            horizontalLost = np.where(closing, discriminant >= 0, c < 0)
+            #Vertically inside separation while |dy + wy t| < vertical
+            climbing = np.abs(wy) > 1e-6
+            crossing1 = (-vertical - dy)/wy
+            crossing2 = (vertical - dy)/wy
+            verticalStart = np.where(climbing, np.minimum(crossing1, crossing2), -np.inf)
+            verticalEnd = np.where(climbing, np.maximum(crossing1, crossing2), np.inf)
+            verticalLost = climbing | (np.abs(dy) < vertical)
+            start = np.maximum(np.maximum(horizontalStart, verticalStart), 0)
+            end = np.minimum(np.minimum(horizontalEnd, verticalEnd), lookahead)
+            conflict = horizontalLost & verticalLost & (start <= end)
+            closest = np.where(closing, np.clip(-(dx*wx + dz*wz)/a, 0, lookahead), 0)
+        hits = np.flatnonzero(conflict)
+        if not len(hits):
+            return ()
+        closest = closest[hits]
+        closestNm = np.hypot(dx[hits] + wx[hits]*closest, dz[hits] + wz[hits]*closest)/NM_TO_M
+        closestFt = np.abs(dy[hits] + wy[hits]*closest)/FT_TO_M
+        separationNm = np.hypot(dx[hits], dz[hits])/NM_TO_M
+        separationFt = np.abs(dy[hits])/FT_TO_M
+        firstIds = ids[first[hits]]
+        secondIds = ids[second[hits]]
+        conflicts = [Conflict(int(min(one, two)), int(max(one, two)), float(when), float(closeAt), float(nm), float(ft),
+                              float(nowNm), float(nowFt))
+                     for one, two, when, closeAt, nm, ft, nowNm, nowFt in
+                     zip(firstIds, secondIds, start[hits], closest, closestNm, closestFt, separationNm, separationFt)]
+        conflicts.sort(key=lambda conflict: (conflict.timeToConflict, conflict.first, conflict.second))
+        return tuple(conflicts)